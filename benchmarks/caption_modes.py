@@ -0,0 +1,137 @@
+"""
+Compare the BLIP captioning modes on this machine.
+
+Each mode is loaded in its own process so peak memory isn't shared between
+them. Captions from every mode are compared against float32, the mode the
+bot has always used.
+
+    python benchmarks/caption_modes.py path/to/images [--modes float32 int8 onnx] [--batch 4] [--repeat 3]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp")
+
+
+def list_images(directory: str) -> list:
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+
+def run_mode(mode: str, paths: list, batch_size: int, repeat: int, results) -> None:
+    import torch
+
+    from helpers.caption_models import load_blip
+    from helpers.image_loader import decode_image
+
+    started = time.perf_counter()
+    processor, model = load_blip(mode)
+    load_seconds = time.perf_counter() - started
+
+    size = processor.image_processor.size["height"]
+    images = []
+    for path in paths:
+        with open(path, "rb") as file:
+            images.append(decode_image(file.read(), size))
+
+    def caption(batch):
+        inputs = processor(images=batch, return_tensors="pt").to("cpu", torch.float32)
+        with torch.inference_mode():
+            out = model.generate(**inputs, max_new_tokens=50)
+        return [text.strip() for text in processor.batch_decode(out, skip_special_tokens=True)]
+
+    # Warm up once so first-call allocation isn't counted as latency
+    caption(images[:1])
+
+    captions, latencies = [], []
+    for attempt in range(repeat):
+        for i in range(0, len(images), batch_size):
+            batch = images[i:i + batch_size]
+            started = time.perf_counter()
+            texts = caption(batch)
+            latencies.append((time.perf_counter() - started) / len(batch))
+            if attempt == 0:
+                captions.extend(texts)
+
+    results.put({
+        "mode": mode,
+        "load_seconds": load_seconds,
+        "median_ms_per_image": statistics.median(latencies) * 1000,
+        "p95_ms_per_image": sorted(latencies)[int(len(latencies) * 0.95)] * 1000,
+        # ru_maxrss is KiB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "captions": captions,
+    })
+
+
+def token_f1(a: str, b: str) -> float:
+    a_words, b_words = a.split(), b.split()
+    common = sum(min(a_words.count(word), b_words.count(word)) for word in set(a_words))
+    if not common:
+        return 0.0
+    precision, recall = common / len(a_words), common / len(b_words)
+    return 2 * precision * recall / (precision + recall)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("images", help="Directory of images to caption")
+    parser.add_argument("--modes", nargs="+", default=["float32", "int8", "onnx"])
+    parser.add_argument("--batch", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="Print the raw results as JSON")
+    args = parser.parse_args()
+
+    paths = list_images(args.images)
+    if not paths:
+        sys.exit(f"No images found in {args.images}")
+
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for mode in args.modes:
+        queue = context.Queue()
+        process = context.Process(target=run_mode, args=(mode, paths, args.batch, args.repeat, queue))
+        process.start()
+        results[mode] = queue.get()
+        process.join()
+
+    baseline = results.get("float32")
+    for result in results.values():
+        if baseline is None:
+            break
+        pairs = list(zip(baseline["captions"], result["captions"]))
+        result["exact_match"] = sum(a == b for a, b in pairs) / len(pairs)
+        result["token_f1"] = statistics.mean(token_f1(a, b) for a, b in pairs)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{len(paths)} images, batch size {args.batch}, {args.repeat} runs\n")
+    print(f"{'mode':<8} {'load s':>7} {'median ms':>10} {'p95 ms':>8} {'peak MB':>8} {'exact':>6} {'tok F1':>7}")
+    for mode, result in results.items():
+        print(
+            f"{mode:<8} {result['load_seconds']:>7.1f} {result['median_ms_per_image']:>10.0f} "
+            f"{result['p95_ms_per_image']:>8.0f} {result['peak_rss_mb']:>8.0f} "
+            f"{result.get('exact_match', float('nan')):>6.0%} {result.get('token_f1', float('nan')):>7.2f}"
+        )
+    if baseline is not None:
+        for i, path in enumerate(paths):
+            differing = {mode: r["captions"][i] for mode, r in results.items() if r["captions"][i] != baseline["captions"][i]}
+            if differing:
+                print(f"\n{os.path.basename(path)}\n  float32: {baseline['captions'][i]}")
+                for mode, text in differing.items():
+                    print(f"  {mode}: {text}")
+
+
+if __name__ == "__main__":
+    main()
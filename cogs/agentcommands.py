@@ -1,23 +1,24 @@
+import asyncio
 import discord
+import functools
 import os
+import time
 from discord import app_commands
 from discord.ext import commands
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import OllamaEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.llms import Ollama
-from langchain.chains import RetrievalQA
-from langchain_community.document_loaders import WikipediaLoader
-from langchain.tools import BaseTool, StructuredTool, Tool
-from langchain.agents import initialize_agent
-from langchain_community.utilities import WikipediaAPIWrapper
-from langchain_community.tools import DuckDuckGoSearchRun
-from langchain_experimental.utilities import PythonREPL
 from dotenv import load_dotenv
 
+from helpers.agent_runtime import InferenceSlots, StepTimer, async_tool, parallel_tool
+from helpers.tool_cache import ToolCache
+from helpers.wikipedia_index import WikipediaIndex
+
 # Load .env file
 load_dotenv()
 
+WIKIPEDIA_MAX_ARTICLES = int(os.getenv("WIKIPEDIA_MAX_ARTICLES", 5))
+AGENT_TOOL_TIMEOUT = float(os.getenv("AGENT_TOOL_TIMEOUT", 20))
+TOOL_CACHE_TTL = float(os.getenv("TOOL_CACHE_TTL", 3600))
+TOOL_CACHE_STALE = float(os.getenv("TOOL_CACHE_STALE", 86400))
+
 def embedder(msg):
     embed = discord.Embed(
             description=f"{msg}",
@@ -28,56 +29,122 @@ def embedder(msg):
 class AgentCommands(commands.Cog, name="agent_commands"):
     def __init__(self, bot):
         self.bot = bot
-        self.llm = ""
-        # Tools
-        self.wikipedia = WikipediaAPIWrapper() # Wikipedia tool
-        self.search = DuckDuckGoSearchRun() # DuckDuckGo tool
-        self.python_repl = PythonREPL()  # Python REPL tool
-        
-        self.wikipedia_tool = Tool(
-            name='wikipedia',
-            func= self.wikipedia.run,
-            description="Useful for when you need to look up a topic, country or person on wikipedia"
-        )
-        self.duckduckgo_tool = Tool(
-            name='DuckDuckGo Search',
-            func= self.search.run,
-            description="Useful for when you need to do a search on the internet to find information that another tool can't find. be specific with your input."
-        )
+        # The tools pull in langchain_community and langchain_experimental, build them on first use
+        self.tools = None
+        # One agent per endpoint, each using that endpoint's LLM
+        self.agents = {}
+        # Popular lookups are answered from cache.db instead of Wikipedia and DuckDuckGo
+        self.tool_cache = ToolCache(ttl=TOOL_CACHE_TTL, stale_ttl=TOOL_CACHE_STALE)
+        self.wikipedia_index = None
+
+    async def cog_load(self):
+        pruned = await self.tool_cache.prune()
+        if pruned:
+            self.bot.logger.info(f"Pruned {pruned} expired tool results")
+
+    async def cog_unload(self):
+        await self.tool_cache.close()
+
+    def get_tools(self):
+        if self.tools is None:
+            from langchain_community.utilities import WikipediaAPIWrapper
+            from langchain_community.tools import DuckDuckGoSearchRun
+            from langchain_experimental.utilities import PythonREPL
+
+            self.wikipedia = WikipediaAPIWrapper() # Wikipedia tool
+            self.search = DuckDuckGoSearchRun() # DuckDuckGo tool
+            self.python_repl = PythonREPL()  # Python REPL tool
+            cached_wikipedia = self.tool_cache.wrap(
+                "wikipedia", self.wikipedia.run, not_found="No good Wikipedia Search Result was found"
+            )
+            cached_search = self.tool_cache.wrap(
+                "duckduckgo", self.search.run, not_found="No good DuckDuckGo Search Result was found"
+            )
+
+            self.wikipedia_tool = async_tool(
+                'wikipedia',
+                self.wikipedia.run,
+                "Useful for when you need to look up a topic, country or person on wikipedia",
+                AGENT_TOOL_TIMEOUT,
+                async_func=cached_wikipedia,
+            )
+            self.duckduckgo_tool = async_tool(
+                'DuckDuckGo Search',
+                self.search.run,
+                "Useful for when you need to do a search on the internet to find information that another tool can't find. be specific with your input.",
+                AGENT_TOOL_TIMEOUT,
+                async_func=cached_search,
+            )
+            # Both lookups at once, for questions where either source might have the answer
+            self.research_tool = parallel_tool(
+                'web research',
+                [("Wikipedia", self.wikipedia.run, cached_wikipedia), ("DuckDuckGo", self.search.run, cached_search)],
+                "Useful for when you need facts about a topic and don't know whether wikipedia or the internet has them. Searches both at the same time.",
+                AGENT_TOOL_TIMEOUT,
+            )
+            self.tools = [
+                # The REPL runs the code in a subprocess and kills it at the timeout
+                async_tool(
+                    "python repl",
+                    functools.partial(self.python_repl.run, timeout=int(AGENT_TOOL_TIMEOUT)),
+                    "useful for when you need to use python to answer a question. You should input python code",
+                    AGENT_TOOL_TIMEOUT + 1,
+                ),
+                self.research_tool,
+                self.duckduckgo_tool,
+                self.wikipedia_tool,
+            ]
+        return self.tools
+
+    def get_agent(self, endpoint):
+        """The search agent for an endpoint, built on first use and kept."""
+        if endpoint.key not in self.agents:
+            from langchain.agents import initialize_agent
+
+            self.agents[endpoint.key] = initialize_agent(
+                agent="zero-shot-react-description",
+                tools=self.get_tools(),
+                llm=endpoint.llm,
+                verbose=True,
+                max_iterations=3,
+                handle_parsing_errors=True,
+            )
+        return self.agents[endpoint.key]
 
     @app_commands.command(name="searchweb", description="Query Web")
     async def search_web(self, interaction: discord.Interaction, prompt: str):
-        self.llm = Ollama(model="llama3")
         name = interaction.user.display_name
         channel_id = interaction.channel.id
-        await interaction.response.send_message(embed=discord.Embed(
+        embed = discord.Embed(
         title=f"{interaction.user.display_name} used Search Web 🌐",
         description=f"Prompt: {prompt}",
         color=0x9C84EF
-        ))
-
-        tools = [
-            Tool(
-                name = "python repl",
-                func=self.python_repl.run,
-                description="useful for when you need to use python to answer a question. You should input python code"
-            )
-        ]
-
-        tools.append(self.duckduckgo_tool)
-        tools.append(self.wikipedia_tool)
-        llm = Ollama(model="llama3")
-
-        zero_shot_agent = initialize_agent(
-            agent="zero-shot-react-description",
-            tools=tools,
-            llm=llm,
-            verbose=True,
-            max_iterations=3,
         )
-
-        observation = zero_shot_agent.run(prompt)
-        print(f"Observation: {observation}")
+        await interaction.response.send_message(embed=embed)
+
+        timer = StepTimer()
+        started = time.perf_counter()
+
+        async def run_agent(endpoint):
+            # Steps of an attempt on a failed endpoint don't count
+            timer.reset()
+            agent = self.get_agent(endpoint)
+            # Only the agent's LLM calls count against the backend's limit, not its tool calls
+            slots = InferenceSlots(self.bot.inference, endpoint.key)
+            try:
+                return await agent.ainvoke({"input": prompt}, config={"callbacks": [slots, timer]})
+            finally:
+                await slots.release_all()
+
+        result = await self.bot.router.run(channel_id, run_agent)
+        observation = result["output"]
+        self.bot.logger.info(f"Observation: {observation}")
+
+        embed.add_field(name="Steps", value=timer.summary(time.perf_counter() - started), inline=False)
+        try:
+            await interaction.edit_original_response(embed=embed)
+        except discord.HTTPException:
+            pass
 
         response = await self.bot.get_cog("chatbot").agent_command(name, channel_id, prompt, observation)
 
@@ -91,57 +158,45 @@ class AgentCommands(commands.Cog, name="agent_commands"):
     async def on_ready(self):
         self.bot.logger.info("Agent Commands cog loaded.")
   
-    # create a command for the wiipedia chroma code is in the wikichroma copy.ipynb that will use the agent_command from pygbot
+    def get_wikipedia_index(self):
+        if self.wikipedia_index is None:
+            self.wikipedia_index = WikipediaIndex(
+                self.bot.embeddings.as_langchain(),
+                self.bot.embeddings.model,
+                max_articles=WIKIPEDIA_MAX_ARTICLES,
+            )
+        return self.wikipedia_index
+
     @app_commands.command(name="wikipedia", description="Wikipedia Search")
     async def wikipedia_search(self, interaction: discord.Interaction, topic: str, wikipedia: str, query: str):
-        loader = WikipediaLoader(query=wikipedia, load_max_docs=100)
-        documents = loader.load()
-        #splitting the text into
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        texts = text_splitter.split_documents(documents)
-
-        """## create the DB"""
-
-        # Embed and store the texts
-        # Supplying a persist_directory will store the embeddings on disk
-        persist_directory = 'db'
-
-        ## here we are using OllamaEmbeddings
-        oembed = OllamaEmbeddings(base_url="http://localhost:11434", model="nomic-embed-text")
-        embedding = oembed()
-        vectordb = Chroma.from_documents(documents=texts,
-                                        embedding=embedding,
-                                        persist_directory=persist_directory)
-        # persiste the db to disk
-        vectordb.persist()
-        vectordb = None
-
-        # Now we can load the persisted database from disk, and use it as normal.
-        vectordb = Chroma(persist_directory=persist_directory,
-                        embedding_function=embedding)
-
-        """## Make a retriever"""
-
-        retriever = vectordb.as_retriever()
-        docs = retriever.get_relevant_documents(query)
-        len(docs)
-        retriever = vectordb.as_retriever(search_kwargs={"k": 5})
-        retriever.search_type
-        retriever.search_kwargs
-
-        # create the chain to answer questions
-        qa_chain = RetrievalQA.from_chain_type(llm=Ollama(model="llama3"),
-                                        chain_type="stuff",
-                                        retriever=retriever,
-                                        return_source_documents=True)                              
-        await interaction.response.send_message(embed=discord.Embed(
+        from langchain.chains import RetrievalQA
+
+        # Indexing a new article takes longer than Discord's 3 second reply window
+        await interaction.response.defer()
+        await interaction.followup.send(embed=discord.Embed(
         title=f"{interaction.user.display_name} used Wikipedia Search 🔍",
         description=f"Prompt: {topic}",
         color=0x9C84EF
-        ), timeout=3)
-        # create a conversation thread in discord that will allow the user to ask questions about the topic
-        self.llm_response = qa_chain(query)
-        await interaction.channel.send(self.llm_response)
+        ))
+
+        index = self.get_wikipedia_index()
+        titles = await index.ensure(wikipedia)
+        if not titles:
+            await interaction.followup.send(embed=embedder(f"No Wikipedia articles found for {wikipedia}."))
+            return
+        # The first use opens the on-disk collection
+        retriever = await asyncio.to_thread(index.retriever, titles)
+
+        def answer(endpoint):
+            qa_chain = RetrievalQA.from_chain_type(llm=endpoint.llm,
+                                            chain_type="stuff",
+                                            retriever=retriever,
+                                            return_source_documents=True)
+            return self.bot.inference.run(endpoint.key, qa_chain.invoke, {"query": query})
+
+        self.llm_response = await self.bot.router.run(interaction.channel_id, answer)
+        sources = sorted({doc.metadata["title"] for doc in self.llm_response["source_documents"]})
+        await interaction.followup.send(f"{self.llm_response['result']}\n\nSources: {', '.join(sources)}"[:2000])
 
 async def setup(bot):
     await bot.add_cog(AgentCommands(bot))
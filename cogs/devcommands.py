@@ -3,6 +3,10 @@ from discord import app_commands
 from discord.ext import commands
 import os
 
+from helpers import checks, db_manager
+from helpers.extensions import load_extension
+from helpers.model_registry import process_rss
+
 
 def embedder(msg):
     embed = discord.Embed(
@@ -29,8 +33,8 @@ class ReloadCogSelect(discord.ui.Select):
 
     async def callback(self, interaction: discord.Interaction):
             cog = self.values[0]
-            await self.parent.bot.reload_extension(f"cogs.{cog}")
-            await interaction.response.send_message(f"Reloaded {cog} cog.")
+            elapsed = await load_extension(self.parent.bot, f"cogs.{cog}", reload=True)
+            await interaction.response.send_message(f"Reloaded {cog} cog in {elapsed:.2f}s.")
 
 class ReloadCogView(discord.ui.View):
     def __init__(self, parent):
@@ -60,6 +64,122 @@ class DevCommands(commands.Cog, name="dev_commands"):
     async def sync(self, interaction: discord.Interaction) -> None:
         await self.bot.tree.sync()
 
+    @app_commands.command(name="inferencestats", description="Show LLM queue depth and throughput")
+    async def inference_stats(self, interaction: discord.Interaction):
+        stats = self.bot.inference.stats()
+        if not stats:
+            await interaction.response.send_message(embed=embedder("No generations have run yet."), delete_after=10)
+            return
+        embed = discord.Embed(title="Inference executor", color=0x9C84EF)
+        for backend, data in stats.items():
+            embed.add_field(
+                name=backend,
+                value=(
+                    f"in flight: {data['in_flight']}/{data['limit']}\n"
+                    f"queued: {data['queued']} (max {data['max_queue_depth']})\n"
+                    f"done: {data['completed']} failed: {data['failed']} cancelled: {data['cancelled']}\n"
+                    f"avg wait: {data['avg_wait']:.2f}s avg run: {data['avg_run']:.2f}s"
+                ),
+                inline=False,
+            )
+        await interaction.response.send_message(embed=embed)
+
+    @app_commands.command(name="backends", description="Show the state of the LLM endpoints")
+    async def backends(self, interaction: discord.Interaction):
+        embed = discord.Embed(title="LLM endpoints", color=0x9C84EF)
+        for data in self.bot.router.stats():
+            latency = f"{data['latency']:.2f}s" if data["latency"] is not None else "n/a"
+            value = (
+                f"pool: {data['pool']}\n"
+                f"{'🟢 healthy' if data['healthy'] else '🔴 down'}\n"
+                f"in flight: {data['in_flight']} latency: {latency} failures: {data['failures']}"
+            )
+            if data["last_error"] and not data["healthy"]:
+                value += f"\nlast error: {data['last_error'][:200]}"
+            embed.add_field(name=data["url"], value=value, inline=False)
+        pinned = self.bot.router.pins.get(str(interaction.channel_id))
+        embed.set_footer(text=f"This channel uses pool: {pinned or 'any'}")
+        await interaction.response.send_message(embed=embed)
+
+    @app_commands.command(name="pinpool", description="Pin this channel to an endpoint pool (use 'any' to unpin)")
+    @checks.is_owner()
+    async def pin_pool(self, interaction: discord.Interaction, pool: str):
+        if pool == "any":
+            self.bot.router.unpin(interaction.channel_id)
+            await interaction.response.send_message(embed=embedder("This channel can use any endpoint again."), delete_after=10)
+            return
+        try:
+            self.bot.router.pin(interaction.channel_id, pool)
+        except ValueError as e:
+            await interaction.response.send_message(embed=embedder(str(e)), delete_after=10)
+            return
+        await interaction.response.send_message(embed=embedder(f"This channel now generates on the {pool} pool."), delete_after=10)
+
+    @app_commands.command(name="dbstats", description="Show message log writer statistics")
+    async def db_stats(self, interaction: discord.Interaction):
+        stats = db_manager.log_writer.stats()
+        embed = discord.Embed(title="Message log writer", color=0x9C84EF)
+        embed.add_field(name="Queued", value=f"{stats['queued']} (max {stats['max_queue_depth']})")
+        embed.add_field(name="Written", value=f"{stats['written']} in {stats['batches']} batches")
+        embed.add_field(name="Failed", value=stats["failed"])
+        embed.add_field(name="Backpressure", value=f"{stats['blocked']} waits, {stats['blocked_time']:.2f}s total")
+        await interaction.response.send_message(embed=embed)
+
+    @app_commands.command(name="embeddings", description="Show embedding cache and batching statistics")
+    async def embeddings(self, interaction: discord.Interaction):
+        stats = self.bot.embeddings.stats()
+        embed = discord.Embed(title=f"Embeddings ({stats['model']})", color=0x9C84EF)
+        embed.add_field(name="Cached vectors", value=stats["cached"])
+        embed.add_field(name="Cache hits", value=f"{stats['hits']} (+{stats['deduplicated']} duplicates)")
+        embed.add_field(name="Embedded", value=f"{stats['embedded']} in {stats['batches']} requests")
+        embed.add_field(name="Queued", value=stats["queued"])
+        embed.add_field(name="Failed", value=stats["failed"])
+        await interaction.response.send_message(embed=embed)
+
+    @app_commands.command(name="recall", description="Show long-term chat recall statistics")
+    async def recall(self, interaction: discord.Interaction):
+        stats = self.bot.get_cog("chatbot").chatbot.semantic_memory.stats()
+        embed = discord.Embed(title="Chat recall", color=0x9C84EF)
+        embed.add_field(name="Indexed messages", value=f"{stats['vectors']} in {stats['channels']} channels")
+        embed.add_field(name="Embedded since start", value=stats["indexed"])
+        embed.add_field(name="Recalls", value=f"{stats['recalls']} ({stats['recalled']} messages recalled)")
+        embed.add_field(name="Average recall", value=f"{stats['average_recall'] * 1000:.1f}ms")
+        await interaction.response.send_message(embed=embed)
+
+    @app_commands.command(name="toolcache", description="Show agent tool cache hits and misses")
+    async def tool_cache(self, interaction: discord.Interaction):
+        cache = self.bot.get_cog("agent_commands").tool_cache
+        embed = discord.Embed(title="Agent tool cache", color=0x9C84EF)
+        for tool, counters in cache.stats().items():
+            embed.add_field(
+                name=tool,
+                value=f"hits: {counters['hits']} stale: {counters['stale']}\nmisses: {counters['misses']} failed: {counters['failed']}",
+            )
+        if not embed.fields:
+            embed.description = "No tool calls yet."
+        embed.set_footer(text=f"Fresh for {cache.ttl:.0f}s, served stale for {cache.stale_ttl:.0f}s more, {cache.refreshing()} refreshing")
+        await interaction.response.send_message(embed=embed)
+
+    @app_commands.command(name="models", description="Show which local models are loaded and their memory use")
+    async def models(self, interaction: discord.Interaction):
+        embed = discord.Embed(title="Local models", color=0x9C84EF)
+        for data in self.bot.models.stats():
+            if data["loaded"]:
+                value = f"🟢 loaded, {data['size'] / 2**20:.0f} MiB of weights"
+                if data["rss_delta"] is not None:
+                    value += f", RSS +{data['rss_delta'] / 2**20:.0f} MiB at load"
+                value += f"\nin use: {data['in_use']} idle: {data['idle']:.0f}s"
+            else:
+                value = "⚪ not loaded"
+            value += f"\nloads: {data['loads']} last load: {data['load_seconds']:.1f}s"
+            if data["prewarm"]:
+                value += " (prewarmed)"
+            embed.add_field(name=data["name"], value=value, inline=False)
+        rss = process_rss()
+        if rss is not None:
+            embed.set_footer(text=f"Bot RSS: {rss / 2**20:.0f} MiB, idle models unload after {self.bot.models.idle_timeout:.0f}s")
+        await interaction.response.send_message(embed=embed)
+
     @app_commands.command(name="test", description="Test command")
     async def test(self, interaction: discord.Interaction):
         await interaction.response.send_message("Test passed.", delete_after=3)
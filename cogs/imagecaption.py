@@ -1,20 +1,44 @@
+import asyncio
+import os
 import discord
 from discord.ext import commands
-from PIL import Image
-from io import BytesIO
-import requests
 import re
-import torch
-from transformers import BlipForConditionalGeneration, BlipProcessor
+from helpers.caption_service import CAPTION_IMAGE_SIZE, CaptionService
+from helpers.caption_cache import CaptionCache, attachment_key, image_key, url_key
+from helpers.image_loader import IMAGE_ERRORS, decode_image, download_image
+
+# Largest image we download for captioning
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", 8 * 1024 * 1024))
+
+
+def load_blip(mode):
+    # torch and transformers are only imported once an image actually needs captioning
+    from helpers import caption_models
+
+    return caption_models.load_blip(mode)
 
 
 class ImageCaptionCog(commands.Cog, name="image_caption"):
 
     def __init__(self, bot):
         self.bot = bot
-        self.processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-        self.model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base",
-                                                                  torch_dtype=torch.float32).to("cpu")
+        mode = os.getenv("CAPTION_MODE", "float32")
+        bot.models.register("blip", lambda: load_blip(mode), prewarm="blip" in bot.prewarm_models)
+        self.captioner = CaptionService(
+            bot.models,
+            "blip",
+            max_batch_size=int(os.getenv("CAPTION_MAX_BATCH", 8)),
+            max_wait=float(os.getenv("CAPTION_MAX_WAIT", 0.05)),
+        )
+        self.caption_cache = CaptionCache(max_entries=int(os.getenv("CAPTION_CACHE_SIZE", 5000)))
+
+    async def cog_load(self):
+        await self.caption_cache.start()
+
+    async def cog_unload(self):
+        self.captioner.close()
+        await self.caption_cache.close()
+        await self.bot.models.unload("blip")
 
     @commands.command(name="image_comment")
     async def image_comment(self, message: discord.Message, message_content) -> None:
@@ -39,26 +63,39 @@ class ImageCaptionCog(commands.Cog, name="image_caption"):
             return message_content
 
         elif url_pattern.match(message_content):
-            # Download the image from the URL and convert it to a PIL image
-            response = requests.get(message_content)
-            image = Image.open(BytesIO(response.content)).convert('RGB')
+            image_url = message_content
+            keys = [url_key(image_url)]
         else:
-            # Download the image from the message and convert it to a PIL image
-            image_url = message.attachments[0].url
-            response = requests.get(image_url)
-            image = Image.open(BytesIO(response.content)).convert('RGB')
+            attachment = message.attachments[0]
+            image_url = attachment.url
+            keys = [attachment_key(attachment.id), url_key(image_url)]
+
+        # Reposted links and attachments are answered without downloading anything
+        caption = await self.caption_cache.get(*keys)
+        if caption is None:
+            # Download the image and convert it to a PIL image
+            try:
+                image = await self.fetch_image(image_url)
+            except IMAGE_ERRORS as e:
+                self.bot.logger.info(f"Not captioning image {image_url}: {e!r}")
+                return f"{message_content} [{message.author.display_name} posts a picture]"
+            content_key = await asyncio.to_thread(image_key, image)
+            caption = await self.caption_cache.get(content_key)
+            if caption is None:
+                # Generate the image caption
+                caption = await self.caption_image(image)
+            await self.caption_cache.put(caption, *keys, content_key)
 
-        # Generate the image caption
-        caption = self.caption_image(image)
         message_content = f"{message_content} [{message.author.display_name} posts a picture of {caption}]"
         return message_content
 
-    def caption_image(self, raw_image):
-        inputs = self.processor(raw_image.convert('RGB'), return_tensors="pt").to("cpu", torch.float32)
-        out = self.model.generate(**inputs, max_new_tokens=50)
-        caption = self.processor.decode(out[0], skip_special_tokens=True)
+    async def fetch_image(self, url):
+        data = await download_image(url, MAX_IMAGE_BYTES)
+        # Decoding is CPU work too, keep it off the event loop
+        return await asyncio.to_thread(decode_image, data, CAPTION_IMAGE_SIZE)
 
-        return caption
+    async def caption_image(self, raw_image):
+        return await self.captioner.caption(raw_image)
 
 
 async def setup(bot):
@@ -1,14 +1,24 @@
 import asyncio
+import os
 from datetime import datetime, timedelta
 import re
 import discord
 from discord.ext import commands
 from discord import app_commands
 from helpers.constants import ALIASES
+from helpers.channel_queue import ChannelWorkQueue
+from helpers.streaming import ProgressiveReply
 
 from helpers.db_manager import log_message
 
-SLEEPTIMER = 5
+# Messages directed at the bot within this many seconds of each other get a single reply
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", 2))
+# Upper bound on how long a burst can keep postponing the reply
+COALESCE_MAX_DELAY = float(os.getenv("COALESCE_MAX_DELAY", 8))
+# Show replies while they are being generated instead of waiting for the full completion
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() in ("1", "true", "yes")
+# Minimum seconds between edits of a streaming reply
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.2))
 
 
 def embedder(msg):
@@ -25,6 +35,11 @@ class ListenerCog(commands.Cog, name="listener"):
         self.bot = bot
         # self.listen_only_mode needs to be a dictionary with the guild id as the key and the value as the boolean
         self.listen_only_mode = {int(guild_id): False for guild_id in self.bot.channel_list}
+        self.reply_queue = ChannelWorkQueue(
+            self.handle_queued_messages, window=COALESCE_WINDOW, max_delay=COALESCE_MAX_DELAY
+        )
+        # Per channel, the task recording the newest message into the chat history
+        self.history_tails = {}
 
     class ListenOnlyModeSelect(discord.ui.Select):
 
@@ -84,42 +99,64 @@ class ListenerCog(commands.Cog, name="listener"):
         else:
             return False
     
-    async def handle_image_message(self, message, mode=''):
-        
-        await log_message(message)
-        image_response = await self.bot.get_cog("image_caption").image_comment(message, message.clean_content)
-
-        if mode == 'nr':
-            await self.bot.get_cog("chatbot").chat_command_nr(message.author.display_name, message.channel.id, image_response)
-        else:
-            response = await self.bot.get_cog("chatbot").chat_command(message, image_response)
-            if response:
-                async with message.channel.typing():
-                    response_message = await message.channel.send(response)
-                    await log_message(response_message)
-
-    async def handle_text_message(self, message, mode=''):
-
-        await log_message(message)
-        if mode == 'nr':
-            await self.bot.get_cog("chatbot").chat_command_nr(message.author.display_name, message.channel.id, message.clean_content)
+    async def get_message_content(self, message):
+        if await self.has_image_attachment(message):
+            return await self.bot.get_cog("image_caption").image_comment(message, message.clean_content)
+        return message.clean_content
+
+    def record_history(self, message) -> asyncio.Task:
+        """
+        Add a message to the channel's chat history after every message that arrived before it.
+
+        Image captions are worked out concurrently, only the additions to the
+        history wait for each other.
+
+        :return: A task that resolves to the content that was recorded.
+        """
+        channel_id = message.channel.id
+        previous = self.history_tails.get(channel_id)
+
+        async def record():
+            content = await self.get_message_content(message)
+            if previous is not None:
+                await asyncio.wait([previous])
+            await self.bot.get_cog("chatbot").chat_command_nr(message.author.display_name, channel_id, content)
+            return content
+
+        task = asyncio.create_task(record())
+        self.history_tails[channel_id] = task
+
+        def forget(done):
+            if self.history_tails.get(channel_id) is done:
+                del self.history_tails[channel_id]
+
+        task.add_done_callback(forget)
+        return task
+
+    async def handle_queued_messages(self, channel_id, items):
+        """Reply once to a burst of messages: every message is in the history already, the last one gets answered."""
+        contents = await asyncio.gather(*(recorded for _, recorded in items), return_exceptions=True)
+        if isinstance(contents[-1], BaseException):
+            raise contents[-1]
+        last, _ = items[-1]
+        await self.send_reply(last, contents[-1])
+
+    async def send_reply(self, message, content):
+        chatbot = self.bot.get_cog("chatbot")
+        if STREAM_RESPONSES:
+            reply = ProgressiveReply(message.channel, min_interval=STREAM_EDIT_INTERVAL)
+            response = ""
+            async with message.channel.typing():
+                async for response in chatbot.chat_stream(message, content, recorded=True):
+                    await reply.update(response)
+            response_message = await reply.finish(response)
         else:
-            response = await self.bot.get_cog("chatbot").chat_command(message, message.clean_content)
-            if response:
-                async with message.channel.typing():
-                    response_message = await message.channel.send(response)
-                    await log_message(response_message)
-
-    async def set_listen_only_mode_timer(self, channel_id):
-        
-        # Start the timer
-        self.listen_only_mode[channel_id] = True
-        print(f"Message Sleep Timer started for channel {channel_id}")
-        await asyncio.sleep(SLEEPTIMER)  # Wait for 10 seconds
-        print(f"Message Sleep Timer ended for channel {channel_id}")
-
-        # Reset the listen-only mode
-        self.listen_only_mode[channel_id] = False
+            async with message.channel.typing():
+                response = await chatbot.chat_command(message, content, recorded=True)
+            response_message = await message.channel.send(response) if response else None
+        if response_message:
+            await log_message(response_message)
+            chatbot.note_message(response_message)
 
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -152,15 +189,15 @@ class ListenerCog(commands.Cog, name="listener"):
         # Determine message type
         message_type = 'nr' if self.listen_only_mode[message.channel.id] or not directed_at_bot else None
 
-        # Handle the message appropriately
-        if await self.has_image_attachment(message):
-            await self.handle_image_message(message, message_type)
+        await log_message(message)
+        self.bot.get_cog("chatbot").note_message(message)
+        # Every message goes into the history in the order it arrived. Only the
+        # reply waits in the per-channel queue, so bursts get a single answer.
+        recorded = self.record_history(message)
+        if message_type is None:
+            self.reply_queue.submit(message.channel.id, (message, recorded))
         else:
-            await self.handle_text_message(message, message_type)
-
-        # Reset the cooldown timer for the channel if the message is directed at the bot and not in cooldown
-        if directed_at_bot and not self.listen_only_mode[message.channel.id]:
-            asyncio.create_task(self.set_listen_only_mode_timer(message.channel.id))
+            await recorded
 
 
 async def setup(bot):
@@ -1,59 +1,49 @@
-import re
-import json
-import requests
 import asyncio
-from typing import Any, List, Mapping, Optional
+import os
 
 import discord
 from discord import app_commands
 from discord.ext import commands
-from discord.ext.commands import Bot
-
-import chromadb
-from chromadb.utils import embedding_functions
-from chromadb.config import Settings
-import uuid
-import langchain
-from langchain.chains import (
-    ConversationChain,
-    LLMChain,
-    LLMMathChain,
-    TransformChain,
-    SequentialChain,
-)
-from langchain_community.chat_models import ChatOllama
-from langchain_community.docstore.in_memory import InMemoryDocstore
-from langchain_community.embeddings import OllamaEmbeddings
-from langchain_community.chat_message_histories import ChatMessageHistory
-from textwrap import dedent
-from langchain.memory import (
-    ConversationBufferMemory,
-    ConversationBufferWindowMemory,
-    ConversationSummaryBufferMemory,
-)
+
+from langchain.chains import ConversationChain
 from langchain.prompts import PromptTemplate
-from langchain.schema import messages_from_dict, messages_to_dict
-from langchain_community.vectorstores import Chroma
-from langchain_community.agent_toolkits.load_tools import load_tools
-from langchain.agents import initialize_agent
-import os
-from langchain.prompts import PromptTemplate, ChatPromptTemplate
-from dotenv import load_dotenv
 from helpers.constants import MAINTEMPLATE, BOTNAME
 from helpers.custom_memory import *
-from pydantic import Field
+from helpers.backend_router import is_transport_error
+from helpers.memory_store import ChannelMemoryStore
+from helpers.semantic_memory import SemanticMemory
+from helpers.tokens import get_token_counter
+from helpers.streaming import StopSequenceFilter
+
+# Longest a reply waits for older messages to be recalled (one query embedding) before going without them
+RECALL_TIMEOUT = float(os.getenv("RECALL_TIMEOUT", 0.5))
 
 class Chatbot:
 
     def __init__(self, char_filename, bot):
         self.bot = bot
-        self.histories = {}  # Initialize the history dictionary
+        # Bounded per-channel memories, persisted to messages.db. The token
+        # budget is filled in by start() once the tokenizer has loaded.
+        self.histories = ChannelMemoryStore(
+            ai_prefix=BOTNAME,
+            k=int(os.getenv("MEMORY_WINDOW", 20)),
+            max_channels=int(os.getenv("MEMORY_MAX_CHANNELS", 200)),
+        )
+        # Older messages related to the one being answered, recalled on top of the window
+        self.semantic_memory = SemanticMemory(
+            self.bot.embeddings,
+            max_tokens=int(os.getenv("RECALL_TOKENS", 512)),
+            top_k=int(os.getenv("RECALL_TOP_K", 4)),
+            index_size=int(os.getenv("RECALL_INDEX_SIZE", 5000)),
+            max_channels=int(os.getenv("RECALL_MAX_CHANNELS", 200)),
+            window=self.histories.k * 2,
+        )
         self.stop_sequences = {}  # Initialize the stop sequences dictionary
         self.bot.logger.info("Endpoint: " + str(self.bot.endpoint))
         self.char_name = BOTNAME
         self.memory = CustomBufferWindowMemory(k=10, ai_prefix=self.char_name)
         self.history = "[Beginning of Conversation]"
-        self.llm = ChatOllama(model="llama3")  # Use the correct class for ChatOllama
+        self.llm = self.bot.router.primary.llm
         self.bot.llm = self.llm
 
         self.template = MAINTEMPLATE
@@ -68,14 +58,35 @@ class Chatbot:
             memory=self.memory,
         )
 
-    async def get_memory_for_channel(self, channel_id):
-        """Get the memory for the channel with the given ID. If no memory exists yet, create one."""
-        if channel_id not in self.histories:
-            self.histories[channel_id] = CustomBufferWindowMemory(
-                k=20, ai_prefix=self.char_name
+    async def start(self):
+        # Loading the tokenizer pulls in transformers, keep it off the loop so other cogs load meanwhile
+        self.token_counter = await asyncio.to_thread(get_token_counter, os.getenv("OLLAMAMODEL", "llama3"))
+        # The history gets whatever the context window has left after the
+        # prompt template and the room reserved for the reply
+        self.template_tokens = self.token_counter.count(MAINTEMPLATE.format(history="", input=""))
+        self.history_token_budget = (
+            int(os.getenv("CONTEXT_TOKENS", 8192)) - int(os.getenv("RESPONSE_TOKENS", 512)) - self.template_tokens
+        )
+        self.histories.max_token_limit = self.history_token_budget
+        self.histories.token_counter = self.token_counter.count
+        self.histories.start()
+        self.semantic_memory.token_counter = self.token_counter.count
+        await self.semantic_memory.start()
+
+    async def recall(self, channel_id, message_content) -> list:
+        """Older messages of the channel related to this one, or nothing if recall is slow or failing."""
+        try:
+            return await asyncio.wait_for(
+                self.semantic_memory.recall(channel_id, message_content),
+                RECALL_TIMEOUT,
             )
-            self.memory = self.histories[channel_id]
-        return self.histories[channel_id]
+        except Exception as e:
+            self.bot.logger.warning(f"Recall skipped: {e!r}")
+            return []
+
+    async def get_memory_for_channel(self, channel_id):
+        """Get the memory for the channel with the given ID, loading its saved history if it isn't in RAM."""
+        return await self.histories.get(channel_id)
 
     async def get_stop_sequence_for_channel(self, channel_id, name):
         name_token = f"{name}:"
@@ -93,7 +104,12 @@ class Chatbot:
             message_content = message_content.replace(f"\n{self.char_name}:", "")
         return message_content
 
-    async def generate_response(self, message, message_content) -> None:
+    async def generate_response(self, message, message_content, recorded: bool = False) -> None:
+        """
+        Generate a reply.
+
+        :param recorded: Whether the message was already added to the history when it arrived.
+        """
         self.bot.logger.info(f"Received message from {message.author.display_name}: {message_content}")
         channel_id = str(message.channel.id)
         name = message.author.display_name
@@ -101,23 +117,79 @@ class Chatbot:
         stop_sequence = await self.get_stop_sequence_for_channel(channel_id, name)
         self.bot.logger.info(f"Stop sequences: {stop_sequence}")
         formatted_message = f"{name}: {message_content}"
+        recall = await self.recall(channel_id, message_content)
 
-        conversation = ConversationChain(
-            prompt=self.PROMPT,
-            llm=self.llm,
-            verbose=True,
-            memory=memory,
-        )
+        input_dict = {"input": formatted_message, "stop": stop_sequence, "recall": recall, "recorded": recorded}
 
-        input_dict = {"input": formatted_message, "stop": stop_sequence}
+        async def generate(endpoint):
+            conversation = ConversationChain(
+                prompt=self.PROMPT,
+                llm=endpoint.llm,
+                verbose=True,
+                memory=memory,
+            )
+            return await self.bot.inference.run(endpoint.key, conversation, input_dict)
 
-        response_text = conversation(input_dict)
+        response_text = await self.bot.router.run(channel_id, generate)
 
         response = await self.detect_and_replace(response_text["response"])
         self.bot.logger.info(f"Response generated: {response}")
 
         return response
 
+    async def stream_response(self, message, message_content, recorded: bool = False):
+        """
+        Generate a reply token by token.
+
+        Yields the visible reply text after every token. Stop sequences are
+        applied to the stream itself, so as soon as the model starts writing
+        another user's turn the stream is closed, which makes the backend stop
+        generating.
+
+        :param recorded: Whether the message was already added to the history when it arrived.
+        """
+        self.bot.logger.info(f"Received message from {message.author.display_name}: {message_content}")
+        channel_id = str(message.channel.id)
+        name = message.author.display_name
+        memory = await self.get_memory_for_channel(channel_id)
+        stop_sequence = await self.get_stop_sequence_for_channel(channel_id, name)
+        formatted_message = f"{name}: {message_content}"
+        recall = await self.recall(channel_id, message_content)
+
+        inputs = {"input": formatted_message, "recall": recall, "recorded": recorded}
+        history = memory.load_memory_variables(inputs)[memory.memory_key]
+        prompt = self.PROMPT.format(history=history, input=formatted_message)
+        stop_filter = StopSequenceFilter(stop_sequence)
+
+        # Fail over to the next endpoint only while nothing has been shown yet
+        last_error = None
+        for endpoint in self.bot.router.candidates(channel_id):
+            try:
+                async with self.bot.router.use(endpoint), self.bot.inference.slot(endpoint.key):
+                    stream = endpoint.llm.astream(prompt, stop=stop_sequence)
+                    try:
+                        async for chunk in stream:
+                            text = stop_filter.feed(getattr(chunk, "content", chunk))
+                            yield await self.detect_and_replace(text)
+                            if stop_filter.stopped:
+                                self.bot.logger.info("Stop sequence reached, aborting generation")
+                                break
+                    finally:
+                        await stream.aclose()
+                break
+            except Exception as e:
+                if stop_filter.text or not is_transport_error(e):
+                    raise
+                last_error = e
+                self.bot.logger.warning(f"Streaming from {endpoint.url} failed ({e}), failing over")
+        else:
+            raise last_error
+
+        response = await self.detect_and_replace(stop_filter.visible.strip())
+        memory.save_context(inputs, {"response": response})
+        self.bot.logger.info(f"Response generated: {response}")
+        yield response
+
     async def add_history(self, name, channel_id, message_content) -> None:
         memory = await self.get_memory_for_channel(str(channel_id))
 
@@ -132,6 +204,8 @@ class Chatbot:
         await self.get_stop_sequence_for_channel(channel_id, name)
         stop_sequence = await self.get_stop_sequence_for_channel(channel_id, name)
         formatted_user_message = f"{name}: {prompt}"
+        # A long search result may take at most half of the room, the rest is for the conversation
+        observation = self.token_counter.truncate(observation, self.history_token_budget // 2)
         formatted_bot_message = f"### Input: {observation}"
         AGENTTEMPLATE = f"""Below is an instruction that describes a task. Write a response that appropriately completes the request.
 
@@ -156,15 +230,20 @@ Answer the user's question with the observation provided in the Input.
         PROMPT = PromptTemplate(
             input_variables=["history", "input"], template=AGENTTEMPLATE
         )
-        conversation = ConversationChain(
-            prompt=PROMPT,
-            llm=self.llm,
-            verbose=True,
-            memory=memory,
-        )
+        # The history budget was worked out for MAINTEMPLATE, this prompt also carries the instruction and observation
+        reserved = self.token_counter.count(PROMPT.format(history="", input="")) - self.template_tokens
+        input_dict = {"input": formatted_user_message, "stop": stop_sequence, "reserved": reserved}
+
+        async def generate(endpoint):
+            conversation = ConversationChain(
+                prompt=PROMPT,
+                llm=endpoint.llm,
+                verbose=True,
+                memory=memory,
+            )
+            return await self.bot.inference.run(endpoint.key, conversation, input_dict)
 
-        input_dict = {"input": formatted_user_message, "stop": stop_sequence}
-        response = conversation(input_dict)
+        response = await self.bot.router.run(channel_id, generate)
 
         return response["response"]
 
@@ -178,11 +257,25 @@ class ChatbotCog(commands.Cog, name="chatbot"):
         if not os.path.exists(self.chatlog_dir):
             os.makedirs(self.chatlog_dir)
 
+    async def cog_load(self):
+        await self.chatbot.start()
+
+    async def cog_unload(self):
+        await self.chatbot.semantic_memory.close()
+        await self.chatbot.histories.close()
+
     @commands.command(name="chat")
-    async def chat_command(self, message, message_content) -> None:
-        response = await self.chatbot.generate_response(message, message_content)
+    async def chat_command(self, message, message_content, recorded=False) -> None:
+        response = await self.chatbot.generate_response(message, message_content, recorded)
         return response
 
+    def chat_stream(self, message, message_content, recorded=False):
+        return self.chatbot.stream_response(message, message_content, recorded)
+
+    def note_message(self, message) -> None:
+        """Tell recall about a message that went into the channel's history, so it isn't recalled as well."""
+        self.chatbot.semantic_memory.note(message.channel.id, message.id)
+
     @commands.command(name="agentcommand")
     async def agent_command(self, name, channel_id, prompt, observation) -> None:
         response = await self.chatbot.agent_command(
@@ -220,7 +313,11 @@ Below is an instruction that describes a task. Write a response that appropriate
         await self.chatbot.add_history(
             interaction.user.display_name, str(channel_id), prompt
         )
-        response = self.chatbot.llm(self.prompt["prompt"])
+        response = await self.bot.router.run(
+            channel_id,
+            lambda endpoint: self.bot.inference.run(endpoint.key, endpoint.llm.invoke, self.prompt["prompt"]),
+        )
+        response = getattr(response, "content", response)
         await interaction.channel.send(response)
         await self.chatbot.add_history(
             self.chatbot.char_name, str(channel_id), response
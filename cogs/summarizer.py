@@ -1,11 +1,19 @@
-import torch
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+import copy
+import hashlib
+import json
+import os
+import time
 import unicodedata
 import discord
 from discord import app_commands
 from discord.ext import commands
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+from helpers import summarization
+
+# Chunks of a long text summarized together in one generate call
+SUMMARY_BATCH_SIZE = int(os.getenv("SUMMARY_BATCH_SIZE", 4))
+# Summarize the chunk summaries again into one, instead of just joining them
+SUMMARY_REDUCE = os.getenv("SUMMARY_REDUCE", "true").lower() in ("1", "true", "yes")
 
 DEFAULT_SUMMARIZE_PARAMS = {
     "temperature": 1.0,
@@ -13,6 +21,7 @@ DEFAULT_SUMMARIZE_PARAMS = {
     "max_length": 500,
     "min_length": 200,
     "length_penalty": 1.5,
+    "num_beams": 2,
     "bad_words": [
         "\n",
         '"',
@@ -34,6 +43,28 @@ DEFAULT_SUMMARIZE_PARAMS = {
     ],
 }
 
+# Named parameter sets for /summarizetext. "detailed" is what the bot has always used.
+SUMMARIZE_PRESETS = {
+    "fast": {**DEFAULT_SUMMARIZE_PARAMS, "max_length": 120, "min_length": 30, "num_beams": 1},
+    "balanced": {**DEFAULT_SUMMARIZE_PARAMS, "max_length": 250, "min_length": 80},
+    "detailed": DEFAULT_SUMMARIZE_PARAMS,
+}
+
+
+def params_key(params: dict) -> str:
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def load_bart():
+    # torch and transformers are only imported once a summary is actually needed
+    import torch
+    from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = AutoModelForSeq2SeqLM.from_pretrained("facebook/bart-large-cnn").to(device)
+    tokenizer = AutoTokenizer.from_pretrained("facebook/bart-large-cnn")
+    return tokenizer, model
+
 
 def embedder(msg):
     embed = discord.Embed(
@@ -47,49 +78,63 @@ class TextSummarizerCog(commands.Cog, name="text_summarizer"):
 
     def __init__(self, bot):
         self.bot = bot
-        self.device = device
-        self.summarization_transformer = AutoModelForSeq2SeqLM.from_pretrained("facebook/bart-large-cnn").to(self.device)
-        self.summarization_tokenizer = AutoTokenizer.from_pretrained("facebook/bart-large-cnn")
-
-    async def summarize_chunks(self, text: str, params: dict) -> str:
-        try:
-            return await self.summarize(text, params)
-        except IndexError:
-            print(
-                "Sequence length too large for model, cutting text in half and calling again"
+        # BART is only loaded once something needs summarizing
+        bot.models.register("bart", load_bart, prewarm="bart" in bot.prewarm_models)
+        self.generation_configs = {}
+        # preset -> (summaries, total seconds)
+        self.preset_latency = {}
+
+    async def cog_unload(self):
+        await self.bot.models.unload("bart")
+
+    def generation_config(self, tokenizer, model, params: dict):
+        """
+        The ``GenerationConfig`` for a parameter set, built once and cached by a hash of the params.
+
+        Starts from the model's own generation config so BART's defaults
+        (forced BOS, no-repeat n-grams, ...) still apply, and holds the
+        bad words already tokenized.
+        """
+        key = params_key(params)
+        config = self.generation_configs.get(key)
+        if config is None:
+            config = copy.deepcopy(model.generation_config)
+            config.update(
+                num_beams=int(params.get("num_beams", 2)),
+                max_length=int(params["max_length"]),
+                min_length=int(params["min_length"]),
+                repetition_penalty=float(params["repetition_penalty"]),
+                temperature=float(params["temperature"]),
+                length_penalty=float(params["length_penalty"]),
+                bad_words_ids=[
+                    tokenizer(bad_word, add_special_tokens=False).input_ids
+                    for bad_word in params["bad_words"]
+                ],
             )
-            new_params = params.copy()
-            new_params["max_length"] = new_params["max_length"] // 2
-            new_params["min_length"] = new_params["min_length"] // 2
-            return await self.summarize_chunks(
-                text[: (len(text) // 2)], new_params
-            ) + self.summarize_chunks(text[(len(text) // 2):], new_params)
+            self.generation_configs[key] = config
+        return config
 
     async def summarize(self, text: str, params: dict) -> str:
-        # Tokenize input
-        inputs = self.summarization_tokenizer(text, return_tensors="pt").to(device)
-        token_count = len(inputs[0])
-
-        bad_words_ids = [
-            self.summarization_tokenizer(bad_word, add_special_tokens=False).input_ids
-            for bad_word in params["bad_words"]
-        ]
-        summary_ids = self.summarization_transformer.generate(
-            inputs["input_ids"],
-            num_beams=2,
-            max_length=max(token_count, int(params["max_length"])),
-            min_length=min(token_count, int(params["min_length"])),
-            repetition_penalty=float(params["repetition_penalty"]),
-            temperature=float(params["temperature"]),
-            length_penalty=float(params["length_penalty"]),
-            bad_words_ids=bad_words_ids,
-        )
-        summary = self.summarization_tokenizer.batch_decode(
-            summary_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True
-        )[0]
+        async with self.bot.models.use("bart") as (summarization_tokenizer, summarization_transformer):
+            config = self.generation_config(summarization_tokenizer, summarization_transformer, params)
+            # Generation runs on the inference workers, never on the event loop
+            summary = await self.bot.inference.run(
+                "bart",
+                summarization.summarize_text,
+                summarization_tokenizer,
+                summarization_transformer,
+                text,
+                {"generation_config": config, "min_length": config.min_length},
+                batch_size=SUMMARY_BATCH_SIZE,
+                reduce=SUMMARY_REDUCE,
+            )
         summary = await self.normalize_string(summary)
         return summary
 
+    def record_latency(self, preset: str, seconds: float) -> None:
+        count, total = self.preset_latency.get(preset, (0, 0.0))
+        self.preset_latency[preset] = (count + 1, total + seconds)
+
     async def normalize_string(self, input: str) -> str:
         output = " ".join(unicodedata.normalize("NFKC", input).strip().split())
         return output
@@ -99,25 +144,33 @@ class TextSummarizerCog(commands.Cog, name="text_summarizer"):
             params = DEFAULT_SUMMARIZE_PARAMS.copy()
 
         print("Summary input:", text, sep="\n")
-        summary = await self.summarize_chunks(text, params)
+        summary = await self.summarize(text, params)
         print("Summary output:", summary, sep="\n")
         return summary
 
     # this command will summarize text and send it back to the user. 
     @app_commands.command(name="summarizetext", description="summarize text")
-    async def summarize_text(self, interaction: discord.Interaction, input_text: str):
+    @app_commands.describe(preset="fast: a few sentences, balanced: a paragraph, detailed: several paragraphs")
+    @app_commands.choices(preset=[app_commands.Choice(name=name, value=name) for name in SUMMARIZE_PRESETS])
+    async def summarize_text(self, interaction: discord.Interaction, input_text: str, preset: str = "detailed"):
         truncated_text = input_text[:30] + "..." if len(input_text) > 30 else input_text
-        await interaction.response.send_message(
-            embed=discord.Embed(
-                title=f"{interaction.user.display_name} used Summarize 📃",
-                description=f"Instructions: {truncated_text}\nGenerating response\nPlease wait..",
-                color=0x9C84EF,
-            )
+        embed = discord.Embed(
+            title=f"{interaction.user.display_name} used Summarize 📃",
+            description=f"Instructions: {truncated_text}\nPreset: {preset}\nGenerating response\nPlease wait..",
+            color=0x9C84EF,
         )
+        await interaction.response.send_message(embed=embed)
 
-        summary = await self.summarize(input_text, DEFAULT_SUMMARIZE_PARAMS.copy())
+        started = time.perf_counter()
+        summary = await self.summarize(input_text, SUMMARIZE_PRESETS[preset])
+        elapsed = time.perf_counter() - started
+        self.record_latency(preset, elapsed)
 
         await interaction.channel.send(summary)
+        count, total = self.preset_latency[preset]
+        embed.description = f"Instructions: {truncated_text}\nPreset: {preset}"
+        embed.set_footer(text=f"Took {elapsed:.1f}s, {preset} averages {total / count:.1f}s over {count} summaries")
+        await interaction.edit_original_response(embed=embed)
 
 
 async def setup(bot):
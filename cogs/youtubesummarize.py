@@ -1,48 +1,141 @@
+import asyncio
+import os
+import time
+
 import discord
 from discord import app_commands
 from discord.ext import commands
-import langchain
 
-from langchain_community.document_loaders import YoutubeLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.chains.summarize import load_summarize_chain
+from helpers import youtube
+
+# The map-reduce prompts LangChain's summarize chain has always used
+MAP_PROMPT = """Write a concise summary of the following:
+
+
+"{text}"
+
+
+CONCISE SUMMARY:"""
+REDUCE_PROMPT = MAP_PROMPT
+
+CHUNK_SIZE = 2000
+CHUNK_OVERLAP = 50
+# Longest text handed to one reduce call, longer sets of summaries are collapsed in groups first
+REDUCE_MAX_CHARS = 12000
+# Chunk summaries of one video generated at once, so a long video can't fill every backend slot
+MAP_CONCURRENCY = int(os.getenv("YOUTUBE_MAP_CONCURRENCY", 4))
+# Seconds between edits of the progress message
+PROGRESS_INTERVAL = 2.0
 
-import torch
 
 class YoutubeSummaryCog(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.llm = self.bot.llm
+        self.model = os.getenv("OLLAMAMODEL", "llama3")
+
+    async def generate(self, channel_id, prompt: str) -> str:
+        response = await self.bot.router.run(
+            channel_id,
+            lambda endpoint: self.bot.inference.run(endpoint.key, endpoint.llm.invoke, prompt),
+        )
+        return getattr(response, "content", response).strip()
+
+    async def summarize_all(self, channel_id, video: str, texts: list, template: str, on_done=None) -> list:
+        """
+        Summarize every text concurrently, reusing summaries cached for this video.
+
+        :param on_done: Called with no arguments each time a summary is ready.
+        """
+        prompts = [template.format(text=text) for text in texts]
+        keys = [youtube.summary_key(self.model, prompt) for prompt in prompts]
+        cached = await youtube.get_summaries(video, keys)
+        semaphore = asyncio.Semaphore(MAP_CONCURRENCY)
+
+        async def summarize_one(prompt, key):
+            if key not in cached:
+                async with semaphore:
+                    summary = await self.generate(channel_id, prompt)
+                await youtube.put_summary(video, key, summary)
+                cached[key] = summary
+            if on_done is not None:
+                on_done()
+            return cached[key]
+
+        return await asyncio.gather(*(summarize_one(prompt, key) for prompt, key in zip(prompts, keys)))
+
+    async def reduce(self, channel_id, video: str, summaries: list) -> str:
+        # Collapse in groups until everything fits one prompt, then combine once
+        while len("\n".join(summaries)) > REDUCE_MAX_CHARS and len(summaries) > 1:
+            groups, group = [], []
+            for summary in summaries:
+                if group and len("\n".join(group + [summary])) > REDUCE_MAX_CHARS:
+                    groups.append("\n".join(group))
+                    group = []
+                group.append(summary)
+            groups.append("\n".join(group))
+            summaries = await self.summarize_all(channel_id, video, groups, REDUCE_PROMPT)
+        (summary,) = await self.summarize_all(channel_id, video, ["\n".join(summaries)], REDUCE_PROMPT)
+        return summary
 
     @app_commands.command(name="youtubesummary", description="Summarize a YouTube video given its URL")
     async def summarize(self, interaction: discord.Interaction, url: str):
         await interaction.response.defer()
 
-        await interaction.followup.send(
-            embed=discord.Embed(
-                title=f"{interaction.user.display_name} used Youtube Summary 📺",
-                description=f"Summarizing {url} \nGenerating response\nPlease wait..",
-                color=0x9C84EF
-            )
+        embed = discord.Embed(
+            title=f"{interaction.user.display_name} used Youtube Summary 📺",
+            description=f"Summarizing {url} \nGenerating response\nPlease wait..",
+            color=0x9C84EF
         )
+        progress = await interaction.followup.send(embed=embed, wait=True)
+        last_edit = 0.0
+
+        async def show(status: str, force: bool = False):
+            nonlocal last_edit
+            if not force and time.monotonic() - last_edit < PROGRESS_INTERVAL:
+                return
+            last_edit = time.monotonic()
+            embed.description = f"Summarizing {url}\n{status}"
+            try:
+                await progress.edit(embed=embed)
+            except discord.HTTPException:
+                pass
+
         try:
-            self.bot.logger.info(f"Loading transcript for URL: {url}")
-            loader = YoutubeLoader.from_youtube_url(url)
-            transcript = loader.load()
+            video = youtube.video_id(url)
+            if video is None:
+                await show("That doesn't look like a YouTube video link.", force=True)
+                return
+
+            self.bot.logger.info(f"Loading transcript for video {video}")
+            started = time.perf_counter()
+            transcript, cached = await youtube.get_transcript(video)
+
+            from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+            text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+            texts = text_splitter.split_text(transcript)
+            source = "cached transcript" if cached else "transcript"
+            await show(f"Loaded {source}, summarizing {len(texts)} parts...", force=True)
 
-            self.bot.logger.info("Splitting text...")
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=50)
-            texts = text_splitter.split_documents(transcript)
+            done = 0
+            pending = []
 
-            self.bot.logger.info("Creating and configuring summarize chain...")
-            chain = load_summarize_chain(llm=self.llm, chain_type="map_reduce", verbose=True)
+            def on_done():
+                nonlocal done
+                done += 1
+                # Edits are rate limited by show() and must not hold up the map step
+                pending.append(asyncio.ensure_future(show(f"Summarized {done}/{len(texts)} parts...")))
 
-            self.bot.logger.info("Running summarize chain...")
-            summary = chain.run(texts)
+            summaries = await self.summarize_all(interaction.channel_id, video, texts, MAP_PROMPT, on_done)
+            await asyncio.gather(*pending)
+            await show("Combining the summaries...", force=True)
+            summary = await self.reduce(interaction.channel_id, video, summaries)
 
-            self.bot.logger.info(f"Summary generated: {summary}")
-            await interaction.followup.send(f'Summary:\n{summary}')
+            elapsed = time.perf_counter() - started
+            self.bot.logger.info(f"Summary of {video} generated in {elapsed:.1f}s: {summary}")
+            await show(f"Done in {elapsed:.1f}s ({len(texts)} parts)", force=True)
+            await interaction.followup.send(f'Summary:\n{summary}'[:2000])
 
         except Exception as e:
             self.bot.logger.error(f"Error occurred: {str(e)}")
@@ -12,8 +12,15 @@ from discord.ext import commands, tasks
 from discord.ext.commands import Bot, Context
 from dotenv import load_dotenv
 import aiosqlite
-from helpers import db_manager
+from helpers import db_manager, migrations
+from helpers.inference import InferenceExecutor
+from helpers.http_client import get_client
+from helpers.model_registry import ModelRegistry
+from helpers.extensions import load_extensions
+from helpers.embeddings import EmbeddingService
 from langchain_community.llms import Ollama
+from langchain_community.chat_models import ChatOllama
+from helpers.backend_router import BackendRouter, Endpoint, parse_endpoints
 
 if not os.path.isfile(f"{os.path.realpath(os.path.dirname(__file__))}/config.json"):
     sys.exit("'config.json' not found! Please add it and try again.")
@@ -24,23 +31,79 @@ else:
 # Load .env file
 load_dotenv()
 
+class DiscordBot(Bot):
+    async def setup_hook(self) -> None:
+        # Runs inside the bot's event loop, so tasks started by cogs keep running
+        await init_db()
+        await self.embeddings.start()
+        await load_cogs()
+
+    async def close(self) -> None:
+        # Unloads the cogs first so they can flush their own state
+        await super().close()
+        # Flush buffered writes and release shared resources
+        await db_manager.close_db()
+        await self.embeddings.close()
+        self.router.stop()
+        self.models.stop()
+        await get_client().close()
+        self.inference.shutdown()
+
+
 # Initialize bot
 intents = discord.Intents.all()
-bot = Bot(command_prefix="/", intents=intents, help_command=None)
+bot = DiscordBot(command_prefix="/", intents=intents, help_command=None)
 
 # Get environment variables
 DISCORD_BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
 CHANNEL_ID = os.getenv("CHANNEL_ID")
 OWNERS = os.getenv("OWNERS")
 
-bot.endpoint = os.getenv("OLLAMAENDPOINT")
-if len(bot.endpoint.split("/api")) > 0:
-    bot.endpoint = bot.endpoint.split("/api")[0]
+OLLAMA_MODEL = os.getenv("OLLAMAMODEL", "llama3")
+
+# Every endpoint gets its own client; the router spreads generations across them
+bot.router = BackendRouter(
+    [
+        Endpoint(
+            url,
+            pool,
+            ChatOllama(
+                base_url=url,
+                model=OLLAMA_MODEL,
+                num_ctx=int(os.getenv("CONTEXT_TOKENS", 8192)),
+                num_predict=int(os.getenv("RESPONSE_TOKENS", 512)),
+            ),
+        )
+        for pool, url in parse_endpoints(
+            os.getenv("OLLAMAENDPOINTS") or os.getenv("OLLAMAENDPOINT") or "http://localhost:11434"
+        )
+    ],
+    health_interval=float(os.getenv("HEALTH_CHECK_INTERVAL", 30)),
+)
+bot.endpoint = bot.router.primary.url
 bot.chatlog_dir = "chatlog_dir"
 bot.endpoint_connected = False
 bot.channel_list = [int(x) for x in CHANNEL_ID.split(",")]
 bot.owners = [int(x) for x in OWNERS.split(",")]
 
+# LLM calls are dispatched to a bounded worker pool so they never block the gateway
+bot.inference = InferenceExecutor(
+    max_workers=int(os.getenv("INFERENCE_WORKERS", 4)),
+    default_limit=int(os.getenv("INFERENCE_CONCURRENCY", 2)),
+)
+
+# Local transformer models load on first use and are dropped again when idle
+bot.models = ModelRegistry(idle_timeout=float(os.getenv("MODEL_IDLE_TIMEOUT", 900)))
+bot.prewarm_models = [name.strip() for name in os.getenv("PREWARM_MODELS", "").split(",") if name.strip()]
+
+# Every cog embeds text through this one cached, batching service
+bot.embeddings = EmbeddingService(
+    bot.endpoint,
+    os.getenv("EMBEDDING_MODEL", "nomic-embed-text"),
+    batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", 64)),
+    max_cached=int(os.getenv("EMBEDDING_CACHE_SIZE", 100000)),
+)
+
 class LoggingFormatter(logging.Formatter):
     # Colors
     black = "\x1b[30m"
@@ -90,23 +153,20 @@ logger.addHandler(file_handler)
 bot.logger = logger
 
 # Set the llm attribute before loading extensions
-bot.llm = Ollama(model="llama3")
+bot.llm = Ollama(base_url=bot.endpoint, model=OLLAMA_MODEL)
 
 async def init_db():
-    async with aiosqlite.connect(
-        f"{os.path.realpath(os.path.dirname(__file__))}/database/database.db"
-    ) as db:
-        with open(
-            f"{os.path.realpath(os.path.dirname(__file__))}/database/schema.sql"
-        ) as file:
-            await db.executescript(file.read())
-        await db.commit()
+    # Creates the databases on first run and applies any pending schema migrations
+    await migrations.migrate_all()
 
 bot.config = config
 
 @bot.event
 async def on_ready():
     await db_manager.setup_db()
+    bot.router.start()
+    # Prewarming waits until we're connected so it never delays the login
+    bot.models.start()
     bot.logger.info(f"Setting up database...")
     bot.logger.info(f"Logged in as {bot.user.name}")
     bot.logger.info(f"discord.py API version: {discord.__version__}")
@@ -221,16 +281,14 @@ async def on_command_error(context: Context, error) -> None:
         raise error
 
 async def load_cogs() -> None:
-    for file in os.listdir(f"{os.path.realpath(os.path.dirname(__file__))}/cogs"):
-        if file.endswith(".py"):
-            extension = file[:-3]
-            try:
-                await bot.load_extension(f"cogs.{extension}")
-            except Exception as e:
-                error_info = f"Failed to load extension {extension}. {type(e).__name__}: {e}"
-                print(error_info)
-                logging.error(f"Traceback: {traceback.format_exc()}")
-
-asyncio.run(load_cogs())
-asyncio.run(init_db())
+    # Cogs don't depend on each other, so they load concurrently
+    await load_extensions(
+        bot,
+        [
+            f"cogs.{file[:-3]}"
+            for file in sorted(os.listdir(f"{os.path.realpath(os.path.dirname(__file__))}/cogs"))
+            if file.endswith(".py")
+        ],
+    )
+
 bot.run(DISCORD_BOT_TOKEN)
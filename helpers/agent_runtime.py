@@ -0,0 +1,170 @@
+import asyncio
+import time
+from contextlib import AsyncExitStack
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import AsyncCallbackHandler, BaseCallbackHandler
+
+
+async def call_with_timeout(name: str, func: Callable[[str], Any], query: str, timeout: float) -> str:
+    """
+    Run a tool function and give up after ``timeout`` seconds.
+
+    Blocking functions run in a worker thread; async ones (such as the
+    functions returned by ``ToolCache.wrap``) are awaited.
+
+    Failures are returned as the observation instead of raised, so the agent
+    can carry on with another tool. A timed out call is no longer awaited,
+    but its thread runs until the underlying request returns.
+    """
+    try:
+        call = func(query) if asyncio.iscoroutinefunction(func) else asyncio.to_thread(func, query)
+        return await asyncio.wait_for(call, timeout)
+    except asyncio.TimeoutError:
+        return f"{name} did not answer within {timeout:g} seconds."
+    except Exception as e:
+        return f"{name} failed: {e}"
+
+
+def async_tool(
+    name: str,
+    func: Callable[[str], str],
+    description: str,
+    timeout: float,
+    async_func: Optional[Callable[[str], Any]] = None,
+):
+    """
+    A LangChain ``Tool`` whose async runs go through :func:`call_with_timeout`.
+
+    :param async_func: Used instead of ``func`` for async runs, e.g. a cached version of it.
+    """
+    from langchain.tools import Tool
+
+    async def coroutine(query: str) -> str:
+        return await call_with_timeout(name, async_func or func, query, timeout)
+
+    return Tool(name=name, func=func, coroutine=coroutine, description=description)
+
+
+def parallel_tool(
+    name: str,
+    sources: List[Tuple[str, Callable[[str], str], Optional[Callable[[str], Any]]]],
+    description: str,
+    timeout: float,
+):
+    """
+    A tool that asks every source at once and returns all of their answers.
+
+    Each source has its own timeout, so one slow source only costs its own
+    answer, and the tool never takes longer than the slowest allowed source.
+
+    :param sources: ``(name, func, async_func)`` triples, ``async_func`` being
+        optional as for :func:`async_tool`.
+    """
+    from langchain.tools import Tool
+
+    async def coroutine(query: str) -> str:
+        answers = await asyncio.gather(
+            *(call_with_timeout(source, async_func or func, query, timeout) for source, func, async_func in sources)
+        )
+        return "\n\n".join(f"{source}: {answer}" for (source, _, _), answer in zip(sources, answers))
+
+    def func(query: str) -> str:
+        return "\n\n".join(f"{source}: {source_func(query)}" for source, source_func, _ in sources)
+
+    return Tool(name=name, func=func, coroutine=coroutine, description=description)
+
+
+class StepTimer(BaseCallbackHandler):
+    """Records how long every LLM call and tool call of an agent run took, in the order they finished."""
+
+    # Timestamps only, no need for a worker thread per callback
+    run_inline = True
+
+    def __init__(self):
+        self.steps: List[Tuple[str, float, bool]] = []
+        self._started: Dict[UUID, Tuple[str, float]] = {}
+
+    def _start(self, run_id: UUID, name: str) -> None:
+        self._started[run_id] = (name, time.perf_counter())
+
+    def _end(self, run_id: UUID, ok: bool = True) -> None:
+        name, started = self._started.pop(run_id, ("step", time.perf_counter()))
+        self.steps.append((name, time.perf_counter() - started, ok))
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id, "🧠 thinking")
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[Any], *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id, "🧠 thinking")
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, ok=False)
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id, f"🔧 {(serialized or {}).get('name', 'tool')}")
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, ok=False)
+
+    def reset(self) -> None:
+        self.steps.clear()
+        self._started.clear()
+
+    def summary(self, elapsed: float) -> str:
+        lines = [f"{name}: {seconds:.1f}s" + ("" if ok else " ❌") for name, seconds, ok in self.steps]
+        lines.append(f"Total: {elapsed:.1f}s")
+        return "\n".join(lines)[-1024:]
+
+
+class InferenceSlots(AsyncCallbackHandler):
+    """
+    Holds an inference slot of one backend for each LLM call of an agent run, and only for those.
+
+    Tool calls in between don't keep other generations on the backend
+    waiting. Pass it before :class:`StepTimer` so the timings leave out the
+    wait for a slot.
+    """
+
+    run_inline = True
+
+    def __init__(self, inference, backend: str):
+        self.inference = inference
+        self.backend = backend
+        self._held: Dict[UUID, AsyncExitStack] = {}
+
+    async def _acquire(self, run_id: UUID) -> None:
+        stack = AsyncExitStack()
+        await stack.enter_async_context(self.inference.slot(self.backend))
+        self._held[run_id] = stack
+
+    async def _release(self, run_id: UUID, error: Optional[BaseException] = None) -> None:
+        stack = self._held.pop(run_id, None)
+        if stack is not None:
+            await stack.__aexit__(type(error) if error else None, error, None)
+
+    async def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> None:
+        await self._acquire(run_id)
+
+    async def on_chat_model_start(
+        self, serialized: Dict[str, Any], messages: List[Any], *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        await self._acquire(run_id)
+
+    async def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        await self._release(run_id)
+
+    async def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        await self._release(run_id, error)
+
+    async def release_all(self) -> None:
+        """Give back slots of calls that never reported their end, e.g. when the run was cancelled."""
+        for run_id in list(self._held):
+            await self._release(run_id, asyncio.CancelledError())
@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+import aiohttp
+import requests
+
+from helpers.http_client import RetryableStatus, get_client
+
+logger = logging.getLogger("discord_bot")
+
+DEFAULT_POOL = "default"
+
+TRANSPORT_ERRORS = (
+    aiohttp.ClientConnectionError,
+    asyncio.TimeoutError,
+    requests.ConnectionError,
+    requests.Timeout,
+    ConnectionError,
+    RetryableStatus,
+)
+# LangChain's Ollama wrappers report error answers as a ValueError with the status in the message
+OLLAMA_STATUS = re.compile(r"status code (\d{3})")
+
+
+def is_transport_error(error: BaseException) -> bool:
+    """
+    Whether an error means the endpoint is unreachable or failing.
+
+    Anything else, such as an output parser or Discord error, would fail the
+    same way on every endpoint, so it neither takes the endpoint out of
+    rotation nor triggers a failover.
+    """
+    if isinstance(error, TRANSPORT_ERRORS):
+        return True
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500
+    if isinstance(error, ValueError):
+        match = OLLAMA_STATUS.search(str(error))
+        return match is not None and int(match.group(1)) >= 500
+    return False
+
+
+def parse_endpoints(spec: str) -> List[Tuple[str, str]]:
+    """
+    Parse an endpoint list such as ``http://a:11434,gpu=http://b:11434``.
+
+    Each comma separated entry is a URL, optionally prefixed with ``pool=``.
+    Entries without a pool go into the default pool. Trailing ``/api...``
+    paths are stripped so the same value works for Ollama and Kobold URLs.
+    """
+    endpoints = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        if "=" in entry.split("://")[0]:
+            pool, _, url = entry.partition("=")
+        else:
+            pool, url = DEFAULT_POOL, entry
+        url = url.split("/api")[0].rstrip("/")
+        endpoints.append((pool.strip() or DEFAULT_POOL, url))
+    return endpoints
+
+
+class Endpoint:
+    """One inference server and its live load figures."""
+
+    def __init__(self, url: str, pool: str, llm: Any, health_path: str = "/api/tags"):
+        self.url = url
+        self.pool = pool
+        self.llm = llm
+        self.health_path = health_path
+        self.in_flight = 0
+        self.latency: Optional[float] = None  # Rolling average in seconds
+        self.healthy = True
+        self.failures = 0
+        self.last_error: Optional[str] = None
+
+    @property
+    def key(self) -> str:
+        return f"{self.pool}:{self.url}"
+
+    def score(self) -> float:
+        # Expected wait if we queue one more request behind the ones in flight
+        return (self.in_flight + 1) * (self.latency if self.latency is not None else 1.0)
+
+
+class BackendRouter:
+    """
+    Routes generations across several inference endpoints.
+
+    Each call goes to the healthy endpoint with the lowest expected wait
+    (in-flight requests times rolling latency) in the channel's pool, and
+    fails over to the next one when the endpoint can't be reached or answers
+    with a server error. Failed endpoints are taken out of rotation until the
+    background health check sees them answering again. Other errors are
+    raised to the caller straight away.
+    """
+
+    def __init__(self, endpoints: Iterable[Endpoint], health_interval: float = 30.0, smoothing: float = 0.3):
+        self.endpoints = list(endpoints)
+        if not self.endpoints:
+            raise ValueError("BackendRouter needs at least one endpoint")
+        self.health_interval = health_interval
+        self.smoothing = smoothing
+        self.pins: Dict[str, str] = {}
+        self._health_task: Optional[asyncio.Task] = None
+
+    @property
+    def pools(self) -> List[str]:
+        return sorted({endpoint.pool for endpoint in self.endpoints})
+
+    @property
+    def primary(self) -> Endpoint:
+        return self.endpoints[0]
+
+    def pin(self, channel_id, pool: str) -> None:
+        if pool not in self.pools:
+            raise ValueError(f"Unknown pool {pool!r}, expected one of {', '.join(self.pools)}")
+        self.pins[str(channel_id)] = pool
+
+    def unpin(self, channel_id) -> None:
+        self.pins.pop(str(channel_id), None)
+
+    def candidates(self, channel_id=None) -> List[Endpoint]:
+        """Endpoints the channel may use, best first. Unhealthy ones are only used as a last resort."""
+        pool = self.pins.get(str(channel_id)) if channel_id is not None else None
+        endpoints = [endpoint for endpoint in self.endpoints if pool is None or endpoint.pool == pool]
+        return sorted(endpoints, key=lambda endpoint: (not endpoint.healthy, endpoint.score()))
+
+    @asynccontextmanager
+    async def use(self, endpoint: Endpoint):
+        """Account one request against the endpoint and record its outcome."""
+        endpoint.in_flight += 1
+        started_at = time.perf_counter()
+        try:
+            yield endpoint
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if not is_transport_error(e):
+                raise
+            endpoint.failures += 1
+            endpoint.healthy = False
+            endpoint.last_error = f"{type(e).__name__}: {e}"
+            raise
+        else:
+            elapsed = time.perf_counter() - started_at
+            if endpoint.latency is None:
+                endpoint.latency = elapsed
+            else:
+                endpoint.latency += self.smoothing * (elapsed - endpoint.latency)
+            endpoint.healthy = True
+        finally:
+            endpoint.in_flight -= 1
+
+    async def run(self, channel_id, func: Callable[[Endpoint], Awaitable[Any]]) -> Any:
+        """Call ``func(endpoint)`` on the best endpoint, failing over to the others on transport errors."""
+        last_error = None
+        for endpoint in self.candidates(channel_id):
+            try:
+                async with self.use(endpoint):
+                    return await func(endpoint)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not is_transport_error(e):
+                    raise
+                last_error = e
+                logger.warning(f"Endpoint {endpoint.url} failed ({type(e).__name__}: {e}), failing over")
+        raise last_error
+
+    async def check_health(self) -> None:
+        session = get_client().session()
+        timeout = aiohttp.ClientTimeout(total=5)
+
+        async def check(endpoint: Endpoint):
+            try:
+                async with session.get(f"{endpoint.url}{endpoint.health_path}", timeout=timeout) as response:
+                    endpoint.healthy = response.status < 500
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                endpoint.healthy = False
+                endpoint.last_error = f"{type(e).__name__}: {e}"
+
+        await asyncio.gather(*(check(endpoint) for endpoint in self.endpoints))
+
+    async def _health_loop(self) -> None:
+        while True:
+            await self.check_health()
+            await asyncio.sleep(self.health_interval)
+
+    def start(self) -> None:
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    def stop(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "url": endpoint.url,
+                "pool": endpoint.pool,
+                "healthy": endpoint.healthy,
+                "in_flight": endpoint.in_flight,
+                "latency": endpoint.latency,
+                "failures": endpoint.failures,
+                "last_error": endpoint.last_error,
+            }
+            for endpoint in self.endpoints
+        ]
@@ -0,0 +1,121 @@
+import asyncio
+import itertools
+import logging
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import aiosqlite
+
+logger = logging.getLogger("discord_bot")
+
+_CLOSE = object()
+
+
+class BatchWriter:
+    """
+    Buffers SQLite writes and commits them in batches.
+
+    One long-lived connection in WAL mode drains a bounded queue of
+    ``(statement, params)`` rows. A batch is written as a single transaction
+    once ``batch_size`` rows are waiting or ``flush_interval`` seconds after
+    its first row, whichever comes first. When the queue is full ``submit``
+    waits, which pushes back on the producers instead of growing without
+    bound. ``close`` writes everything still queued before returning.
+    """
+
+    def __init__(self, path: str, batch_size: int = 200, flush_interval: float = 1.0, max_queue: int = 10000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._db: Optional[aiosqlite.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self.submitted = 0
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+        self.blocked = 0
+        self.blocked_time = 0.0
+        self.max_queue_depth = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        self._db = await aiosqlite.connect(self.path)
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        # WAL makes NORMAL durable against application crashes; only an OS crash can lose the last batch
+        await self._db.execute("PRAGMA synchronous=NORMAL")
+        self._task = asyncio.create_task(self._run())
+
+    async def submit(self, statement: str, params: Sequence[Any]) -> None:
+        item = (statement, tuple(params))
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.blocked += 1
+            started_at = time.perf_counter()
+            await self._queue.put(item)
+            self.blocked_time += time.perf_counter() - started_at
+        self.submitted += 1
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            item = await self._queue.get()
+            if item is _CLOSE:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _CLOSE:
+                    closing = True
+                    break
+                batch.append(item)
+            await self._write(batch)
+
+    async def _write(self, batch: List[Tuple[str, tuple]]) -> None:
+        try:
+            # Consecutive rows for the same statement go in one executemany
+            for statement, rows in itertools.groupby(batch, key=lambda item: item[0]):
+                await self._db.executemany(statement, [params for _, params in rows])
+            await self._db.commit()
+        except Exception:
+            self.failed += len(batch)
+            logger.exception(f"Failed to write a batch of {len(batch)} rows to {self.path}")
+            await self._db.rollback()
+        else:
+            self.written += len(batch)
+            self.batches += 1
+
+    async def close(self) -> None:
+        if self.running:
+            await self._queue.put(_CLOSE)
+            await self._task
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._queue.qsize(),
+            "submitted": self.submitted,
+            "written": self.written,
+            "batches": self.batches,
+            "failed": self.failed,
+            "blocked": self.blocked,
+            "blocked_time": self.blocked_time,
+            "max_queue_depth": self.max_queue_depth,
+        }
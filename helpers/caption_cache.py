@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import urlsplit, urlunsplit
+
+import aiosqlite
+from PIL import Image
+
+from helpers.batch_writer import BatchWriter
+from helpers.db_manager import CACHE_PATH
+
+logger = logging.getLogger("discord_bot")
+
+UPSERT_SQL = """
+    INSERT INTO caption_cache(key, caption, last_used) VALUES (?, ?, ?)
+    ON CONFLICT(key) DO UPDATE SET caption=excluded.caption, last_used=excluded.last_used"""
+TOUCH_SQL = "UPDATE caption_cache SET last_used=? WHERE key=?"
+DELETE_SQL = "DELETE FROM caption_cache WHERE key=?"
+
+
+def url_key(url: str) -> str:
+    # Discord CDN links carry expiring signature parameters, the path alone identifies the file
+    parts = urlsplit(url)
+    if parts.netloc.endswith(("discordapp.com", "discordapp.net")):
+        parts = parts._replace(query="")
+    return f"url:{urlunsplit(parts._replace(fragment=''))}"
+
+
+def attachment_key(attachment_id: int) -> str:
+    return f"attachment:{attachment_id}"
+
+
+def image_key(image: Image.Image) -> str:
+    """
+    Hash of the decoded pixels.
+
+    The same file posted under another URL or as another attachment maps to
+    the same key. A perceptual hash would also match re-encoded copies, but
+    it gives every flat or low-detail image (text screenshots, meme
+    templates) the same key and serves one caption for all of them.
+    """
+    digest = hashlib.sha256(f"{image.mode}:{image.size}:".encode())
+    digest.update(image.tobytes())
+    return f"image:{digest.hexdigest()}"
+
+
+class CaptionCache:
+    """
+    Size-bounded LRU of captions, persisted to ``cache.db``.
+
+    Every caption is stored under each key it was found by (URL, attachment
+    id, image hash), so a repost is usually recognised before it is even
+    downloaded. Lookups only touch memory; inserts, recency updates and
+    evictions are written behind through a :class:`BatchWriter`.
+    """
+
+    def __init__(self, max_entries: int = 5000, path: str = CACHE_PATH):
+        self.max_entries = max_entries
+        self.path = path
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._writer = BatchWriter(path, flush_interval=5.0)
+        self.hits = 0
+        self.misses = 0
+
+    async def start(self) -> None:
+        async with aiosqlite.connect(self.path) as db:
+            async with db.execute(
+                "SELECT key, caption FROM caption_cache ORDER BY last_used DESC LIMIT ?", (self.max_entries,)
+            ) as cursor:
+                rows = await cursor.fetchall()
+            # Anything beyond the newest max_entries was evicted while we were offline
+            await db.execute(
+                "DELETE FROM caption_cache WHERE key NOT IN (SELECT key FROM caption_cache ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            await db.commit()
+        self._entries = OrderedDict(reversed(rows))
+        await self._writer.start()
+
+    async def get(self, *keys: str) -> Optional[str]:
+        for key in keys:
+            caption = self._entries.get(key)
+            if caption is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                await self._writer.submit(TOUCH_SQL, (int(time.time()), key))
+                return caption
+        self.misses += 1
+        return None
+
+    async def put(self, caption: str, *keys: str) -> None:
+        now = int(time.time())
+        for key in keys:
+            self._entries[key] = caption
+            self._entries.move_to_end(key)
+            await self._writer.submit(UPSERT_SQL, (key, caption, now))
+        while len(self._entries) > self.max_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            await self._writer.submit(DELETE_SQL, (evicted,))
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    async def close(self) -> None:
+        await self._writer.close()
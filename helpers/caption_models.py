@@ -0,0 +1,120 @@
+import hashlib
+import logging
+import os
+
+import torch
+import transformers
+from transformers import BlipForConditionalGeneration, BlipProcessor
+from transformers.modeling_outputs import BaseModelOutputWithPooling
+
+logger = logging.getLogger("discord_bot")
+
+BLIP_MODEL = "Salesforce/blip-image-captioning-base"
+CAPTION_MODES = ("float32", "int8", "onnx")
+ARTIFACT_DIR = f"{os.path.realpath(os.path.dirname(__file__))}/../models"
+
+
+class OnnxVisionEncoder(torch.nn.Module):
+    """
+    Drop-in replacement for ``BlipForConditionalGeneration.vision_model``
+    that runs the exported encoder with ONNX Runtime.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def forward(self, pixel_values: torch.Tensor, **kwargs) -> BaseModelOutputWithPooling:
+        (last_hidden_state,) = self.session.run(None, {"pixel_values": pixel_values.cpu().numpy()})
+        last_hidden_state = torch.from_numpy(last_hidden_state)
+        return BaseModelOutputWithPooling(
+            last_hidden_state=last_hidden_state, pooler_output=last_hidden_state[:, 0, :]
+        )
+
+
+class _VisionExport(torch.nn.Module):
+    def __init__(self, vision_model):
+        super().__init__()
+        self.vision_model = vision_model
+
+    def forward(self, pixel_values):
+        return self.vision_model(pixel_values=pixel_values, return_dict=False)[0]
+
+
+def _artifact_dir(model_name: str) -> str:
+    # Exports are only valid for the library versions that produced them
+    key = f"{model_name}|{torch.__version__}|{transformers.__version__}"
+    path = os.path.join(ARTIFACT_DIR, model_name.replace("/", "--"), hashlib.sha1(key.encode()).hexdigest()[:12])
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def export_vision_encoder(model: BlipForConditionalGeneration, model_name: str, image_size: int) -> str:
+    """
+    Export the vision encoder to ONNX and quantize its weights to int8.
+
+    The result is cached next to the other model artifacts, so only the first
+    start after installing or upgrading pays for the export.
+    """
+    directory = _artifact_dir(model_name)
+    float_path = os.path.join(directory, "vision_encoder.onnx")
+    int8_path = os.path.join(directory, "vision_encoder.int8.onnx")
+    if os.path.exists(int8_path):
+        return int8_path
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    logger.info(f"Exporting the {model_name} vision encoder to ONNX, this only happens once")
+    dummy = torch.zeros(1, 3, image_size, image_size)
+    torch.onnx.export(
+        _VisionExport(model.vision_model).eval(),
+        (dummy,),
+        float_path,
+        input_names=["pixel_values"],
+        output_names=["last_hidden_state"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "last_hidden_state": {0: "batch"}},
+        opset_version=17,
+    )
+    quantize_dynamic(float_path, int8_path + ".tmp", weight_type=QuantType.QInt8)
+    # Rename last so a crash mid-export never leaves a half-written artifact behind
+    os.replace(int8_path + ".tmp", int8_path)
+    os.remove(float_path)
+    return int8_path
+
+
+def load_blip(mode: str = "float32", model_name: str = BLIP_MODEL):
+    """
+    Load the BLIP processor and captioning model for CPU inference.
+
+    :param mode: ``float32`` runs the model as published. ``int8`` applies
+        dynamic int8 quantization to every linear layer. ``onnx`` runs the
+        vision encoder as an int8 ONNX Runtime graph and the text decoder as
+        dynamically quantized torch; it falls back to ``int8`` when
+        onnxruntime isn't installed.
+    :return: A ``(processor, model)`` tuple.
+    """
+    if mode not in CAPTION_MODES:
+        raise ValueError(f"Unknown caption mode {mode!r}, expected one of {', '.join(CAPTION_MODES)}")
+    processor = BlipProcessor.from_pretrained(model_name)
+    model = BlipForConditionalGeneration.from_pretrained(model_name, torch_dtype=torch.float32).to("cpu").eval()
+
+    if mode == "onnx":
+        try:
+            encoder_path = export_vision_encoder(model, model_name, processor.image_processor.size["height"])
+            model.vision_model = OnnxVisionEncoder(encoder_path)
+        except ImportError:
+            logger.warning("onnxruntime is not installed, using int8 mode for image captioning")
+            mode = "int8"
+        else:
+            model.text_decoder = torch.quantization.quantize_dynamic(
+                model.text_decoder, {torch.nn.Linear}, dtype=torch.qint8
+            )
+    if mode == "int8":
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    logger.info(f"Loaded {model_name} for captioning in {mode} mode")
+    return processor, model
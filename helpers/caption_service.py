@@ -0,0 +1,111 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+from helpers.model_registry import ModelRegistry
+
+logger = logging.getLogger("discord_bot")
+
+# Input resolution of the BLIP base processor, images are decoded close to it
+CAPTION_IMAGE_SIZE = 384
+
+
+class CaptionService:
+    """
+    Micro-batching BLIP captioner.
+
+    ``caption`` queues an image and returns once its caption is ready. A
+    single worker collects queued images for up to ``max_wait`` seconds (or
+    until ``max_batch_size`` are waiting) and captions them with one
+    ``generate`` call on a dedicated thread, so the event loop never runs
+    the model and bursts of images share a forward pass. The processor and
+    model are borrowed from ``models`` for each batch, so they are only
+    loaded once something needs a caption.
+    """
+
+    def __init__(
+        self,
+        models: ModelRegistry,
+        model_name: str,
+        max_batch_size: int = 8,
+        max_wait: float = 0.05,
+        max_new_tokens: int = 50,
+    ):
+        self.models = models
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_new_tokens = max_new_tokens
+        self._queue: asyncio.Queue = asyncio.Queue()
+        # Torch already spreads one batch across the cores, more threads would only contend
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="caption")
+        self._worker: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.images = 0
+
+    async def caption(self, image: Image.Image) -> str:
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((image, future))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch: List[Tuple[Image.Image, asyncio.Future]] = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Callers that gave up don't need a caption
+            batch = [(image, future) for image, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+            try:
+                async with self.models.use(self.model_name) as (processor, model):
+                    captions = await loop.run_in_executor(
+                        self._executor, self._caption_batch, processor, model, [image for image, _ in batch]
+                    )
+            except Exception as e:
+                logger.exception(f"Captioning a batch of {len(batch)} images failed")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.images += len(batch)
+            for (_, future), caption in zip(batch, captions):
+                if not future.done():
+                    future.set_result(caption)
+
+    def _caption_batch(self, processor, model, images: List[Image.Image]) -> List[str]:
+        # Already imported by the model loader, importing here keeps torch out of startup
+        import torch
+
+        inputs = processor(images=[image.convert("RGB") for image in images], return_tensors="pt").to("cpu", torch.float32)
+        with torch.inference_mode():
+            out = model.generate(**inputs, max_new_tokens=self.max_new_tokens)
+        return [caption.strip() for caption in processor.batch_decode(out, skip_special_tokens=True)]
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "batches": self.batches,
+            "images": self.images,
+            "avg_batch": self.images / self.batches if self.batches else 0.0,
+        }
+
+    def close(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Set
+
+logger = logging.getLogger("discord_bot")
+
+
+class ChannelWorkQueue:
+    """
+    Per-channel debounce queue that coalesces bursts into a single job.
+
+    Items submitted for a channel are held until no new item has arrived for
+    ``window`` seconds (or ``max_delay`` seconds have passed since the first
+    one), then handed to ``handler`` as one batch. At most one batch is being
+    handled per channel at a time; items that arrive while a batch is running
+    are collected into the next batch, and a pending flush whose items were
+    already taken by an earlier one is dropped.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Any, List[Any]], Awaitable[None]],
+        window: float = 2.0,
+        max_delay: float = 8.0,
+    ):
+        self.handler = handler
+        self.window = window
+        self.max_delay = max_delay
+        self._pending: Dict[Any, List[Any]] = {}
+        self._first_seen: Dict[Any, float] = {}
+        self._timers: Dict[Any, asyncio.Task] = {}
+        self._locks: Dict[Any, asyncio.Lock] = {}
+        # The loop only keeps weak references to tasks
+        self._flushes: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.coalesced = 0
+        self.superseded = 0
+
+    def submit(self, channel_id, item) -> None:
+        """Queue an item for the channel and (re)start its debounce timer."""
+        self._pending.setdefault(channel_id, []).append(item)
+        now = time.monotonic()
+        first_seen = self._first_seen.setdefault(channel_id, now)
+
+        timer = self._timers.get(channel_id)
+        if timer is not None and not timer.done():
+            timer.cancel()
+        delay = min(self.window, max(0.0, first_seen + self.max_delay - now))
+        self._timers[channel_id] = asyncio.create_task(self._debounce(channel_id, delay))
+
+    def in_flight(self, channel_id) -> bool:
+        lock = self._locks.get(channel_id)
+        return lock is not None and lock.locked()
+
+    async def _debounce(self, channel_id, delay: float) -> None:
+        await asyncio.sleep(delay)
+        # The flush runs in its own task so a later submit() can't cancel a
+        # generation that has already started.
+        task = asyncio.create_task(self._flush(channel_id))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, channel_id) -> None:
+        lock = self._locks.setdefault(channel_id, asyncio.Lock())
+        async with lock:
+            batch = self._pending.pop(channel_id, [])
+            self._first_seen.pop(channel_id, None)
+            if not batch:
+                self.superseded += 1
+                return
+            self.batches += 1
+            self.coalesced += len(batch) - 1
+            try:
+                await self.handler(channel_id, batch)
+            except Exception:
+                logger.exception(f"Error while handling queued messages for channel {channel_id}")
@@ -2,6 +2,8 @@ import json
 import os
 from typing import Callable, TypeVar
 
+import discord
+from discord import app_commands
 from discord.ext import commands
 
 from exceptions import *
@@ -10,21 +12,35 @@ from helpers import db_manager
 T = TypeVar("T")
 
 
+def _owner_ids() -> list:
+    with open(
+        f"{os.path.realpath(os.path.dirname(__file__))}/../config.json"
+    ) as file:
+        return json.load(file)["owners"]
+
+
 def is_owner() -> Callable[[T], T]:
     """
     This is a custom check to see if the user executing the command is an owner of the bot.
+
+    It guards both prefix/hybrid commands and slash-only ``app_commands`` commands.
     """
 
     async def predicate(context: commands.Context) -> bool:
-        with open(
-            f"{os.path.realpath(os.path.dirname(__file__))}/../config.json"
-        ) as file:
-            data = json.load(file)
-        if context.author.id not in data["owners"]:
+        if context.author.id not in _owner_ids():
             raise UserNotOwner
         return True
 
-    return commands.check(predicate)
+    async def app_predicate(interaction: discord.Interaction) -> bool:
+        if interaction.user.id not in _owner_ids():
+            await interaction.response.send_message("You are not an owner of the bot!", ephemeral=True)
+            return False
+        return True
+
+    def decorator(func: T) -> T:
+        return commands.check(predicate)(app_commands.check(app_predicate)(func))
+
+    return decorator
 
 
 def not_blacklisted() -> Callable[[T], T]:
@@ -1,29 +1,72 @@
-from typing import Any, Dict, List
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
 from langchain.memory.chat_memory import BaseChatMemory
-from langchain.schema import BaseMessage, HumanMessage, AIMessage, SystemMessage, ChatMessage
+from langchain.schema import BaseChatMessageHistory, BaseMessage, HumanMessage, ChatMessage
+
+def format_message(m: BaseMessage, human_prefix: str = "Human", ai_prefix: str = "AI") -> str:
+    """Render a single message as a line of the prompt history."""
+    role = {"human": human_prefix, "ai": ai_prefix, "system": "System"}.get(m.type)
+    if role is None:
+        if isinstance(m, ChatMessage):
+            role = m.role
+        else:
+            raise ValueError(f"Got unsupported message type: {m}")
+    if role == human_prefix:
+        return f"{m.content}"
+    return f"{role}: {m.content}"
+
 
 def get_buffer_string(
     messages: List[BaseMessage], human_prefix: str = "Human", ai_prefix: str = "AI"
 ) -> str:
     """Get buffer string of messages."""
-    string_messages = []
-    for m in messages:
-        if isinstance(m, HumanMessage):
-            role = human_prefix
-        elif isinstance(m, AIMessage):
-            role = ai_prefix
-        elif isinstance(m, SystemMessage):
-            role = "System"
-        elif isinstance(m, ChatMessage):
-            role = m.role
-        else:
-            raise ValueError(f"Got unsupported message type: {m}")
-        if role == human_prefix:
-            string_messages.append(f"{m.content}")
-        else:
-            string_messages.append(f"{role}: {m.content}")
+    return "\n".join(format_message(m, human_prefix, ai_prefix) for m in messages)
 
-    return "\n".join(string_messages)
+
+class RingBufferChatMessageHistory(BaseChatMessageHistory):
+    """Chat history that only keeps the newest ``maxlen`` messages."""
+
+    def __init__(self, maxlen: int, on_add: Optional[Callable[[BaseMessage], None]] = None):
+        self._messages = deque(maxlen=maxlen)
+        # Rendered prompt lines per (human_prefix, ai_prefix), kept in step with _messages
+        self._rendered: Dict[Tuple[str, str], Deque[str]] = {}
+        self.on_add = on_add
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        return list(self._messages)
+
+    def add_message(self, message: BaseMessage) -> None:
+        self._messages.append(message)
+        for (human_prefix, ai_prefix), lines in self._rendered.items():
+            lines.append(format_message(message, human_prefix, ai_prefix))
+        if self.on_add is not None:
+            self.on_add(message)
+
+    def load(self, messages: List[BaseMessage]) -> None:
+        """Fill the buffer without reporting the messages as new."""
+        self._messages.extend(messages)
+        self._rendered.clear()
+
+    def render(self, human_prefix: str, ai_prefix: str) -> Deque[str]:
+        """
+        Rendered lines of the buffered messages.
+
+        The first call for a pair of prefixes renders the whole buffer; after
+        that every new message only renders itself and the oldest line falls
+        off the bounded deque.
+        """
+        key = (human_prefix, ai_prefix)
+        if key not in self._rendered:
+            self._rendered[key] = deque(
+                (format_message(m, human_prefix, ai_prefix) for m in self._messages),
+                maxlen=self._messages.maxlen,
+            )
+        return self._rendered[key]
+
+    def clear(self) -> None:
+        self._messages.clear()
+        self._rendered.clear()
 
 
 class CustomBufferWindowMemory(BaseChatMemory):
@@ -31,7 +74,19 @@ class CustomBufferWindowMemory(BaseChatMemory):
 
     ai_prefix: str = "AI"
     memory_key: str = "history"
+    # The recall lines travel next to the input, so name the input explicitly
+    input_key: Optional[str] = "input"
+    # Optional input holding recalled older messages, put ahead of the window
+    recall_key: str = "recall"
+    # Optional input, true when the input was already added to the history as it arrived
+    recorded_key: str = "recorded"
+    # Optional input, tokens the prompt takes on top of the template max_token_limit was worked out for
+    reserved_key: str = "reserved"
     k: int = 5
+    # When set, the window is the newest messages that fit in this many tokens
+    # (minus the tokens of the current input) rather than all of the last k
+    max_token_limit: Optional[int] = None
+    token_counter: Optional[Callable[[str], int]] = None
 
     @property
     def buffer(self) -> List[BaseMessage]:
@@ -45,14 +100,48 @@ class CustomBufferWindowMemory(BaseChatMemory):
 
     def add_input_only(self, input_str: str) -> None:
         """Add only a user message to the chat memory."""
-        self.chat_memory.messages.append(HumanMessage(content=input_str))
+        self.chat_memory.add_message(HumanMessage(content=input_str))
 
     def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, str]:
         """Return history buffer."""
-        buffer: Any = self.buffer[-self.k * 2 :] if self.k > 0 else []
-        buffer = get_buffer_string(
-            buffer,
-            human_prefix="",
-            ai_prefix=self.ai_prefix,
-        )
-        return {self.memory_key: buffer}
+        if self.k <= 0:
+            return {self.memory_key: ""}
+        if isinstance(self.chat_memory, RingBufferChatMessageHistory):
+            lines = list(self.chat_memory.render(human_prefix="", ai_prefix=self.ai_prefix))
+        else:
+            lines = [format_message(m, "", self.ai_prefix) for m in self.buffer]
+        lines = lines[-self.k * 2 :]
+        if inputs.get(self.recorded_key) and lines and lines[-1] == inputs.get("input"):
+            # Nothing was said after it, show it once, as the input
+            lines = lines[:-1]
+        recall = inputs.get(self.recall_key)
+        if recall:
+            recall = "[Earlier messages]\n" + "\n".join(recall) + "\n[Recent messages]"
+        if self.max_token_limit is not None and self.token_counter is not None:
+            reserved = int(inputs.get(self.reserved_key) or 0)
+            if recall:
+                reserved += self.token_counter(recall) + 1
+            lines = self._fit_to_budget(lines, inputs, reserved=reserved)
+        if recall:
+            lines = [recall] + lines
+        return {self.memory_key: "\n".join(lines)}
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        if inputs.get(self.recorded_key):
+            # The input is in the history already, at the point it arrived
+            _, output_str = self._get_input_output(inputs, outputs)
+            self.chat_memory.add_ai_message(output_str)
+            return
+        super().save_context(inputs, outputs)
+
+    def _fit_to_budget(self, lines: List[str], inputs: Dict[str, Any], reserved: int = 0) -> List[str]:
+        """Keep the newest lines whose tokens fit in the budget left after the input and ``reserved``."""
+        budget = self.max_token_limit - reserved - self.token_counter(str(inputs.get("input", "")))
+        kept = 0
+        for line in reversed(lines):
+            # +1 for the newline joining it to the next line
+            budget -= self.token_counter(line) + 1
+            if budget < 0:
+                break
+            kept += 1
+        return lines[len(lines) - kept :]
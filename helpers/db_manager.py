@@ -2,36 +2,72 @@ import os
 import discord
 import aiosqlite
 import json
+import time
+from datetime import datetime
+
+from helpers.batch_writer import BatchWriter
 
 DATABASE_PATH = f"{os.path.realpath(os.path.dirname(__file__))}/../database/database.db"
 MESSAGES_PATH = f"{os.path.realpath(os.path.dirname(__file__))}/../database/messages.db"
+CACHE_PATH = f"{os.path.realpath(os.path.dirname(__file__))}/../database/cache.db"
+
+
+# In-process copies of the blacklist and warns tables, filled by load_caches() and
+# kept in step by the functions below. None means "not loaded, ask the database".
+blacklist_cache: set = None
+warns_cache: dict = None
+
+# Message logging goes through one buffered writer instead of a connection per message
+log_writer = BatchWriter(MESSAGES_PATH)
+
+LOG_MESSAGE_SQL = '''
+    INSERT OR IGNORE INTO log_message(
+        id,
+        guild_id,
+        channel_id,
+        author_id,
+        author_name,
+        author_display_name,
+        content,
+        created_at,
+        edited_at,
+        jump_url,
+        mentions,
+        type,
+        webhook_id
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
 
 
 async def setup_db():
-    # Create the messages table
-    await create_messages_table()
+    # Tables are created by helpers.migrations before the bot starts
+    await load_caches()
+    log_writer.batch_size = int(os.getenv("LOG_BATCH_SIZE", 200))
+    log_writer.flush_interval = float(os.getenv("LOG_FLUSH_INTERVAL", 2))
+    await log_writer.start()
 
 
-async def create_messages_table():
-    async with aiosqlite.connect(MESSAGES_PATH) as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS log_message(
-                id INTEGER,
-                guild_id INTEGER,
-                channel_id INTEGER,
-                author_id INTEGER,
-                author_name TEXT,
-                author_display_name TEXT,
-                content TEXT,
-                created_at TEXT,
-                edited_at TEXT,
-                jump_url TEXT,
-                mentions TEXT,
-                type INTEGER,
-                webhook_id INTEGER
-            )
-        ''')
-        await db.commit()
+async def close_db():
+    """
+    Write out everything still buffered. Called when the bot shuts down.
+    """
+    await log_writer.close()
+
+
+async def load_caches():
+    """
+    This function will load the blacklist and all warnings into memory.
+    """
+    global blacklist_cache, warns_cache
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        async with db.execute("SELECT user_id FROM blacklist") as cursor:
+            blacklist = {int(row[0]) for row in await cursor.fetchall()}
+        async with db.execute(
+            "SELECT user_id, server_id, moderator_id, reason, created_at, id FROM warns ORDER BY id"
+        ) as cursor:
+            warns = {}
+            for row in await cursor.fetchall():
+                warns.setdefault((int(row[0]), int(row[1])), []).append(row)
+    blacklist_cache, warns_cache = blacklist, warns
 
 
 async def get_blacklisted_users() -> list:
@@ -42,48 +78,95 @@ async def get_blacklisted_users() -> list:
     """
     async with aiosqlite.connect(DATABASE_PATH) as db:
         async with db.execute(
-            "SELECT user_id, strftime('%s', created_at) FROM blacklist"
+            "SELECT user_id, created_at FROM blacklist"
         ) as cursor:
             result = await cursor.fetchall()
             return result
 
 
+def to_epoch_ms(moment: datetime) -> int:
+    return int(moment.timestamp() * 1000)
+
+
+def message_row(message: discord.Message) -> tuple:
+    return (
+        message.id,
+        message.guild.id if message.guild else None,
+        message.channel.id,
+        message.author.id,
+        message.author.name,
+        message.author.display_name,
+        message.content,
+        to_epoch_ms(message.created_at),
+        to_epoch_ms(message.edited_at) if message.edited_at else None,
+        message.jump_url,
+        json.dumps([user.id for user in message.mentions]),
+        message.type.value,
+        message.webhook_id,
+    )
+
+
 async def log_message(message: discord.Message):
-    async with aiosqlite.connect(MESSAGES_PATH) as db:
-        await db.execute('''
-                    INSERT INTO log_message(
-                        id,
-                        guild_id,
-                        channel_id,
-                        author_id,
-                        author_name,
-                        author_display_name,
-                        content,
-                        created_at,
-                        edited_at,
-                        jump_url,
-                        mentions,
-                        type,
-                        webhook_id
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', (
-                        message.id,
-                        message.guild.id if message.guild else None,
-                        message.channel.id,
-                        message.author.id,
-                        message.author.name,
-                        message.author.display_name,
-                        message.content,
-                        str(message.created_at),
-                        str(message.edited_at) if message.edited_at else None,
-                        message.jump_url,
-                        json.dumps([user.id for user in message.mentions]),
-                        message.type.value,  # Changed here
-                        message.webhook_id
-                    ))
+    """
+    This function will queue a message for the message log.
 
+    :param message: The message that should be logged.
+    """
+    if log_writer.running:
+        await log_writer.submit(LOG_MESSAGE_SQL, message_row(message))
+        return
+    # The writer only runs once the bot is ready
+    async with aiosqlite.connect(MESSAGES_PATH) as db:
+        await db.execute(LOG_MESSAGE_SQL, message_row(message))
         await db.commit()
 
 
+async def get_channel_messages(channel_id: int, limit: int = 50, before: int = None) -> list:
+    """
+    This function will return a page of a channel's logged messages, newest first.
+
+    Rows still buffered by the log writer are not visible yet.
+
+    :param channel_id: The ID of the channel.
+    :param limit: The maximum number of messages to return.
+    :param before: Only return messages older than the message with this ID.
+        Pass the ``id`` of the last row of a page to get the next one.
+    :return: A list of (id, author_id, author_display_name, content, created_at) rows.
+    """
+    query = "SELECT id, author_id, author_display_name, content, created_at FROM log_message WHERE channel_id=?"
+    params = [channel_id]
+    if before is not None:
+        query += " AND id < ?"
+        params.append(before)
+    query += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+    async with aiosqlite.connect(MESSAGES_PATH) as db:
+        async with db.execute(query, params) as cursor:
+            return await cursor.fetchall()
+
+
+async def get_author_messages(author_id: int, limit: int = 50, before: int = None) -> list:
+    """
+    This function will return a page of a user's logged messages across all channels, newest first.
+
+    :param author_id: The ID of the user.
+    :param limit: The maximum number of messages to return.
+    :param before: Only return messages older than the message with this ID.
+        Pass the ``id`` of the last row of a page to get the next one.
+    :return: A list of (id, channel_id, content, created_at) rows.
+    """
+    query = "SELECT id, channel_id, content, created_at FROM log_message WHERE author_id=?"
+    params = [author_id]
+    if before is not None:
+        query += " AND id < ?"
+        params.append(before)
+    query += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+    async with aiosqlite.connect(MESSAGES_PATH) as db:
+        async with db.execute(query, params) as cursor:
+            return await cursor.fetchall()
+
+
 async def is_blacklisted(user_id: int) -> bool:
     """
     This function will check if a user is blacklisted.
@@ -91,6 +174,8 @@ async def is_blacklisted(user_id: int) -> bool:
     :param user_id: The ID of the user that should be checked.
     :return: True if the user is blacklisted, False if not.
     """
+    if blacklist_cache is not None:
+        return int(user_id) in blacklist_cache
     async with aiosqlite.connect(DATABASE_PATH) as db:
         async with db.execute(
             "SELECT * FROM blacklist WHERE user_id=?", (user_id,)
@@ -108,6 +193,8 @@ async def add_user_to_blacklist(user_id: int) -> int:
     async with aiosqlite.connect(DATABASE_PATH) as db:
         await db.execute("INSERT INTO blacklist(user_id) VALUES (?)", (user_id,))
         await db.commit()
+        if blacklist_cache is not None:
+            blacklist_cache.add(int(user_id))
         rows = await db.execute("SELECT COUNT(*) FROM blacklist")
         async with rows as cursor:
             result = await cursor.fetchone()
@@ -123,6 +210,8 @@ async def remove_user_from_blacklist(user_id: int) -> int:
     async with aiosqlite.connect(DATABASE_PATH) as db:
         await db.execute("DELETE FROM blacklist WHERE user_id=?", (user_id,))
         await db.commit()
+        if blacklist_cache is not None:
+            blacklist_cache.discard(int(user_id))
         rows = await db.execute("SELECT COUNT(*) FROM blacklist")
         async with rows as cursor:
             result = await cursor.fetchone()
@@ -147,17 +236,23 @@ async def add_warn(user_id: int, server_id: int, moderator_id: int, reason: str)
         async with rows as cursor:
             result = await cursor.fetchone()
             warn_id = result[0] + 1 if result is not None else 1
+            created_at = int(time.time())
             await db.execute(
-                "INSERT INTO warns(id, user_id, server_id, moderator_id, reason) VALUES (?, ?, ?, ?, ?)",
+                "INSERT INTO warns(id, user_id, server_id, moderator_id, reason, created_at) VALUES (?, ?, ?, ?, ?, ?)",
                 (
                     warn_id,
                     user_id,
                     server_id,
                     moderator_id,
                     reason,
+                    created_at,
                 ),
             )
             await db.commit()
+            if warns_cache is not None:
+                warns_cache.setdefault((int(user_id), int(server_id)), []).append(
+                    (user_id, server_id, moderator_id, reason, created_at, warn_id)
+                )
             return warn_id
 
 
@@ -179,6 +274,9 @@ async def remove_warn(warn_id: int, user_id: int, server_id: int) -> int:
             ),
         )
         await db.commit()
+        key = (int(user_id), int(server_id))
+        if warns_cache is not None and key in warns_cache:
+            warns_cache[key] = [row for row in warns_cache[key] if row[5] != warn_id]
         rows = await db.execute(
             "SELECT COUNT(*) FROM warns WHERE user_id=? AND server_id=?",
             (
@@ -199,9 +297,11 @@ async def get_warnings(user_id: int, server_id: int) -> list:
     :param server_id: The ID of the server that should be checked.
     :return: A list of all the warnings of the user.
     """
+    if warns_cache is not None:
+        return list(warns_cache.get((int(user_id), int(server_id)), []))
     async with aiosqlite.connect(DATABASE_PATH) as db:
         rows = await db.execute(
-            "SELECT user_id, server_id, moderator_id, reason, strftime('%s', created_at), id FROM warns WHERE user_id=? AND server_id=?",
+            "SELECT user_id, server_id, moderator_id, reason, created_at, id FROM warns WHERE user_id=? AND server_id=?",
             (
                 user_id,
                 server_id,
@@ -0,0 +1,360 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import aiosqlite
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from helpers.batch_writer import BatchWriter
+from helpers.db_manager import CACHE_PATH
+from helpers.http_client import get_client
+
+logger = logging.getLogger("discord_bot")
+
+EMBEDDINGS_PATH = f"{os.path.realpath(os.path.dirname(__file__))}/../database/embeddings"
+
+INSERT_SQL = "INSERT OR IGNORE INTO embedding(model, hash, row) VALUES (?, ?, ?)"
+PRUNE_SQL = "DELETE FROM embedding WHERE model=? AND row < ?"
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Append-only float32 vector file, read through a memory map.
+
+    Rows are numbered from the first vector ever stored, and the file holds
+    rows ``base`` onwards: row ``n`` is at position ``n - base``. The key
+    index is kept in memory (and persisted by the caller), while the vectors
+    stay on disk and are paged in on demand.
+
+    Once the file holds more than ``max_rows`` vectors it is compacted down
+    to the newest half. The kept rows are copied to a new file and
+    ``meta.json`` is switched over to it in one atomic replace, so a crash
+    leaves either the old or the new file in use and the row numbers the
+    caller persisted stay valid.
+    """
+
+    def __init__(self, directory: str, max_rows: int = 100000):
+        self.directory = directory
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.max_rows = max_rows
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.dim: Optional[int] = None
+        self.base = 0
+        self.rows = 0
+        self._index: Dict[str, int] = {}
+        self._map: Optional[np.memmap] = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def open(self, index: Dict[str, int]) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as file:
+                meta = json.load(file)
+            self.dim = meta["dim"]
+            self.base = meta.get("base", 0)
+            self.vectors_path = os.path.join(self.directory, meta.get("file", "vectors.f32"))
+        if os.path.exists(self.vectors_path):
+            stored = os.path.getsize(self.vectors_path) // (self.dim * 4) if self.dim else 0
+            # Drop a partly written last row, or appends would land misaligned after it
+            with open(self.vectors_path, "r+b") as file:
+                file.truncate(stored * (self.dim or 0) * 4)
+        else:
+            stored = 0
+        self.rows = self.base + stored
+        # Rows past the end of the file were indexed but never written, e.g. after a
+        # crash, and rows before the base were compacted away
+        self._index = {key: row for key, row in index.items() if self.base <= row < self.rows}
+        self._remap()
+
+    def _remap(self) -> None:
+        self._map = (
+            np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self.rows - self.base, self.dim))
+            if self.rows > self.base
+            else None
+        )
+
+    def _write_meta(self) -> None:
+        temporary = self.meta_path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump({"dim": self.dim, "base": self.base, "file": os.path.basename(self.vectors_path)}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.meta_path)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        row = self._index.get(key)
+        if row is None:
+            return None
+        with self._lock:
+            if row < self.base:
+                return None  # Compacted away since the lookup
+            if self._map is None or row - self.base >= self._map.shape[0]:
+                self._remap()
+            return np.array(self._map[row - self.base])
+
+    def append(self, keys: Sequence[str], vectors: np.ndarray) -> List[int]:
+        """Store vectors under their keys and return the rows they were written to. Blocking."""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._write_meta()
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Got {vectors.shape[1]} dimensional embeddings, the cache holds {self.dim}")
+            with open(self.vectors_path, "ab") as file:
+                file.write(vectors.tobytes())
+            rows = list(range(self.rows, self.rows + len(keys)))
+            self.rows += len(keys)
+            self._index.update(zip(keys, rows))
+            if self.rows - self.base > self.max_rows:
+                self._compact()
+        return rows
+
+    def _compact(self) -> None:
+        """Keep only the newest ``max_rows // 2`` vectors. Called with the lock held."""
+        base = self.rows - self.max_rows // 2
+        self._remap()
+        path = os.path.join(self.directory, f"vectors-{base}.f32")
+        with open(path, "wb") as file:
+            file.write(np.ascontiguousarray(self._map[base - self.base :]).tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+        old_path = self.vectors_path
+        self.vectors_path, self.base = path, base
+        self._write_meta()
+        self._map = None
+        os.remove(old_path)
+        self._index = {key: row for key, row in self._index.items() if row >= base}
+        self._remap()
+        logger.info(f"Compacted the embedding cache in {self.directory} to its newest {self.rows - base} vectors")
+
+
+class EmbeddingService:
+    """
+    Shared, cached, batching text embedder.
+
+    Texts are identified by a hash of their content. Vectors already in the
+    on-disk cache are returned without a request, texts that are already
+    being embedded for another caller are waited on rather than sent again,
+    and everything else is queued. A single worker sends the queue to
+    Ollama's ``/api/embed`` in multi-input requests of up to ``batch_size``
+    texts, waiting at most ``max_wait`` seconds for a batch to fill.
+
+    Only texts embedded with ``persist`` (the default for :meth:`embed`) are
+    added to the cache; one-off queries are embedded and forgotten.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        model: str,
+        batch_size: int = 64,
+        max_wait: float = 0.02,
+        max_cached: int = 100000,
+        directory: str = EMBEDDINGS_PATH,
+        path: str = CACHE_PATH,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.path = path
+        self.cache = EmbeddingCache(os.path.join(directory, re.sub(r"[^A-Za-z0-9_.-]", "_", model)), max_cached)
+        self._writer = BatchWriter(path, flush_interval=2.0)
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._pending: Dict[str, asyncio.Future] = {}
+        # Queued texts that some caller wants cached
+        self._persist: Set[str] = set()
+        self._worker: Optional[asyncio.Task] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+        self.batches = 0
+        self.embedded = 0
+        self.failed = 0
+
+    async def start(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        async with aiosqlite.connect(self.path) as db:
+            async with db.execute("SELECT hash, row FROM embedding WHERE model=?", (self.model,)) as cursor:
+                index = dict(await cursor.fetchall())
+        await asyncio.to_thread(self.cache.open, index)
+        await self._writer.start()
+        logger.info(f"Embedding cache for {self.model} holds {len(self.cache)} vectors")
+
+    async def embed(self, texts: Sequence[str], persist: bool = True) -> np.ndarray:
+        """
+        Embed texts, in order.
+
+        :param persist: Whether to cache newly embedded vectors. Texts unlikely
+            to be seen again, such as search queries, shouldn't be.
+        :return: A ``(len(texts), dim)`` float32 array.
+        """
+        keys = [text_key(text) for text in texts]
+        vectors: Dict[str, np.ndarray] = {}
+        waiting: Dict[str, asyncio.Future] = {}
+        for key, text in zip(keys, texts):
+            if key in vectors or key in waiting:
+                self.deduplicated += 1
+                continue
+            vector = self.cache.get(key)
+            if vector is not None:
+                self.hits += 1
+                vectors[key] = vector
+                continue
+            if persist:
+                self._persist.add(key)
+            future = self._pending.get(key)
+            if future is None:
+                self.misses += 1
+                future = self.loop.create_future()
+                self._pending[key] = future
+                self._queue.put_nowait((key, text, future))
+            else:
+                self.deduplicated += 1
+            waiting[key] = future
+        if waiting:
+            if self._worker is None or self._worker.done():
+                self._worker = asyncio.create_task(self._run())
+            # Shielded, other callers may be waiting on the same futures
+            results = await asyncio.gather(*(asyncio.shield(future) for future in waiting.values()))
+            vectors.update(zip(waiting, results))
+        if not keys:
+            return np.zeros((0, self.cache.dim or 0), dtype=np.float32)
+        return np.stack([vectors[key] for key in keys])
+
+    async def embed_one(self, text: str, persist: bool = False) -> np.ndarray:
+        """Embed a single text, by default a one-off query that isn't cached."""
+        return (await self.embed([text], persist))[0]
+
+    async def _run(self) -> None:
+        while True:
+            batch: List[Tuple[str, str, asyncio.Future]] = [await self._queue.get()]
+            deadline = self.loop.time() + self.max_wait
+            while len(batch) < self.batch_size:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            keys = [key for key, _, _ in batch]
+            try:
+                vectors = await self._request([text for _, text, _ in batch])
+                if len(vectors) != len(keys):
+                    raise ValueError(f"Ollama returned {len(vectors)} embeddings for {len(keys)} texts")
+                kept = [i for i, key in enumerate(keys) if key in self._persist]
+                base = self.cache.base
+                rows = (
+                    await asyncio.to_thread(self.cache.append, [keys[i] for i in kept], vectors[kept])
+                    if kept
+                    else []
+                )
+            except Exception as e:
+                logger.exception(f"Embedding a batch of {len(batch)} texts failed")
+                self.failed += len(batch)
+                for key, _, future in batch:
+                    self._pending.pop(key, None)
+                    self._persist.discard(key)
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            if self.cache.base > base:
+                await self._writer.submit(PRUNE_SQL, (self.model, self.cache.base))
+            for i, row in zip(kept, rows):
+                if row >= self.cache.base:
+                    await self._writer.submit(INSERT_SQL, (self.model, keys[i], row))
+            self.batches += 1
+            self.embedded += len(batch)
+            for (key, _, future), vector in zip(batch, vectors):
+                self._pending.pop(key, None)
+                self._persist.discard(key)
+                if not future.done():
+                    future.set_result(vector)
+
+    async def _request(self, texts: List[str]) -> np.ndarray:
+        data = await get_client().post_json(f"{self.base_url}/api/embed", {"model": self.model, "input": texts})
+        if "embeddings" not in data:
+            raise ValueError(f"Ollama returned no embeddings: {data.get('error', data)}")
+        return np.asarray(data["embeddings"], dtype=np.float32)
+
+    def as_langchain(self) -> "ServiceEmbeddings":
+        return ServiceEmbeddings(self)
+
+    def stats(self) -> dict:
+        return {
+            "model": self.model,
+            "cached": len(self.cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "deduplicated": self.deduplicated,
+            "batches": self.batches,
+            "embedded": self.embedded,
+            "failed": self.failed,
+            "queued": self._queue.qsize(),
+        }
+
+    async def close(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+        # Nothing will embed what is still queued, don't leave its callers waiting
+        error = RuntimeError("Embedding service closed")
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+        self._persist.clear()
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        await self._writer.close()
+
+
+class ServiceEmbeddings(Embeddings):
+    """
+    LangChain ``Embeddings`` backed by an :class:`EmbeddingService`.
+
+    The blocking methods hand the work to the bot's event loop and wait for
+    it, so they must be called from worker threads (which is where LangChain
+    vector stores run in this bot); on the loop itself use the async methods.
+    """
+
+    def __init__(self, service: EmbeddingService):
+        self.service = service
+
+    def _wait(self, coroutine):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.service.loop:
+            coroutine.close()
+            raise RuntimeError("Blocking embedding call on the event loop, use the async methods instead")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.service.loop).result()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._wait(self.service.embed(texts)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._wait(self.service.embed_one(text)).tolist()
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return (await self.service.embed(texts)).tolist()
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.service.embed_one(text)).tolist()
@@ -0,0 +1,177 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+logger = logging.getLogger("discord_bot")
+
+# Gateway answers, the backend behind them never started on the request
+RETRY_STATUSES = {502, 503, 504}
+# Failures to connect, the request was never sent. aiohttp before 3.10 raises
+# the same ServerTimeoutError for connect and read timeouts, so only 3.10+
+# retries connect timeouts.
+ASYNC_CONNECT_ERRORS = (
+    aiohttp.ClientConnectorError,
+    getattr(aiohttp, "ConnectionTimeoutError", aiohttp.ClientConnectorError),
+)
+
+
+class RetryableStatus(Exception):
+    """Raised internally when a server answers with a status worth retrying."""
+
+    def __init__(self, status: int, url: str):
+        self.status = status
+        super().__init__(f"{url} answered with HTTP {status}")
+
+
+def sync_connect_failed(error: requests.RequestException) -> bool:
+    """Whether a ``requests`` error happened before the request reached the server."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        # A dropped connection mid-request is a ConnectionError too, but the server may have the request
+        return isinstance(getattr(error.args[0], "reason", None), NewConnectionError)
+    return False
+
+
+def backoff_delay(attempt: int, base: float, cap: float = 8.0) -> float:
+    """Full-jitter exponential backoff."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class HttpClient:
+    """
+    Shared, pooled HTTP client for the inference backends.
+
+    Async callers get a single keep-alive ``aiohttp`` session, sync callers
+    (LangChain's ``_call`` running on the inference worker pool) get a pooled
+    ``requests`` session. Both apply the same timeouts and retry with jittered
+    exponential backoff, but only when the request can't have reached the
+    backend: failures to connect and 502, 503 or 504 answers. Generations
+    aren't idempotent, so a read timeout is never retried.
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 300.0,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        pool_size: int = 32,
+    ):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._sync_session: Optional[requests.Session] = None
+
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    def sync_session(self) -> requests.Session:
+        if self._sync_session is None:
+            self._sync_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            self._sync_session.mount("http://", adapter)
+            self._sync_session.mount("https://", adapter)
+        return self._sync_session
+
+    @asynccontextmanager
+    async def request(self, method: str, url: str, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        """
+        Open a request and yield the response once it has a non-retryable status.
+
+        Only connecting and the status line are retried; once the response is
+        handed to the caller its body is consumed exactly once, so streaming
+        responses are safe to use here.
+        """
+        attempt = 0
+        while True:
+            try:
+                response = await self.session().request(method, url, **kwargs)
+                if response.status in RETRY_STATUSES:
+                    response.release()
+                    raise RetryableStatus(response.status, url)
+            except (*ASYNC_CONNECT_ERRORS, RetryableStatus) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = backoff_delay(attempt, self.backoff)
+                logger.warning(f"{method} {url} failed ({e}), retrying in {delay:.2f}s")
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            try:
+                response.raise_for_status()
+                yield response
+            finally:
+                response.release()
+            return
+
+    async def post_json(self, url: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        async with self.request("POST", url, json=payload) as response:
+            return await response.json(content_type=None)
+
+    def post_json_sync(self, url: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        attempt = 0
+        while True:
+            try:
+                response = self.sync_session().post(
+                    url, json=payload, timeout=(self.connect_timeout, self.read_timeout)
+                )
+                if response.status_code in RETRY_STATUSES:
+                    raise RetryableStatus(response.status_code, url)
+            except (requests.ConnectionError, RetryableStatus) as e:
+                if attempt >= self.max_retries or not (isinstance(e, RetryableStatus) or sync_connect_failed(e)):
+                    raise
+                delay = backoff_delay(attempt, self.backoff)
+                logger.warning(f"POST {url} failed ({e}), retrying in {delay:.2f}s")
+                attempt += 1
+                time.sleep(delay)
+                continue
+            response.raise_for_status()
+            return response.json()
+
+    async def iter_sse(self, url: str, payload: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """POST ``payload`` and yield the JSON ``data:`` payload of every server-sent event."""
+        async with self.request("POST", url, json=payload) as response:
+            async for raw_line in response.content:
+                line = raw_line.decode("utf-8").strip()
+                if line.startswith("data:"):
+                    yield json.loads(line[len("data:"):].strip())
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        if self._sync_session is not None:
+            self._sync_session.close()
+
+
+_client: Optional[HttpClient] = None
+
+
+def get_client() -> HttpClient:
+    """Return the process-wide client, configured from the environment on first use."""
+    global _client
+    if _client is None:
+        _client = HttpClient(
+            connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT", 5)),
+            read_timeout=float(os.getenv("HTTP_READ_TIMEOUT", 300)),
+            max_retries=int(os.getenv("HTTP_MAX_RETRIES", 3)),
+            pool_size=int(os.getenv("HTTP_POOL_SIZE", 32)),
+        )
+    return _client
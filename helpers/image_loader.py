@@ -0,0 +1,72 @@
+import asyncio
+import io
+import logging
+from typing import List
+
+import aiohttp
+from PIL import Image
+
+from helpers.http_client import get_client
+
+logger = logging.getLogger("discord_bot")
+
+CHUNK_SIZE = 64 * 1024
+# Longest a whole image download may take, a slow or trickling server is given up on
+DOWNLOAD_TIMEOUT = 15.0
+
+
+class ImageDownloadError(Exception):
+    """
+    Thrown when a URL doesn't point to an image we are willing to download.
+    """
+
+
+# Everything fetching and decoding an image can fail with: refused downloads,
+# HTTP errors (e.g. expired CDN links), timeouts, and files PIL can't or won't decode
+IMAGE_ERRORS = (ImageDownloadError, aiohttp.ClientError, asyncio.TimeoutError, OSError, Image.DecompressionBombError)
+
+
+async def download_image(url: str, max_bytes: int, timeout: float = DOWNLOAD_TIMEOUT) -> bytes:
+    """
+    Stream an image into memory, refusing anything that isn't an image or is too large.
+
+    The size limit is checked against ``Content-Length`` before reading and
+    again while streaming, so a server that lies about the length is cut off
+    as soon as it goes over. The download shares the pooled session but not
+    its retries or long read timeout: it is tried once and has ``timeout``
+    seconds in total.
+    """
+    chunks: List[bytes] = []
+    size = 0
+    async with get_client().session().get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+        response.raise_for_status()
+        content_type = response.headers.get("Content-Type", "")
+        if not content_type.startswith("image/"):
+            raise ImageDownloadError(f"{url} is {content_type or 'of unknown type'}, not an image")
+        if response.content_length is not None and response.content_length > max_bytes:
+            raise ImageDownloadError(f"{url} is {response.content_length} bytes, over the {max_bytes} byte limit")
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_bytes:
+                raise ImageDownloadError(f"{url} is over the {max_bytes} byte limit")
+            chunks.append(chunk)
+    # One copy into the final bytes, no buffer regrowing on the way
+    return b"".join(chunks)
+
+
+def decode_image(data: bytes, target_size: int = 384) -> Image.Image:
+    """
+    Decode only as much of the image as captioning needs.
+
+    JPEGs are decoded straight at a reduced scale with ``draft``, other
+    formats are shrunk with ``reduce`` (a cheap box filter) while keeping the
+    short side at or above ``target_size``. Only the first frame of animated
+    images is ever decoded.
+    """
+    image = Image.open(io.BytesIO(data))
+    image.draft("RGB", (target_size, target_size))
+    image = image.convert("RGB")
+    factor = min(image.size) // target_size
+    if factor > 1:
+        image = image.reduce(factor)
+    return image
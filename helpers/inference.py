@@ -0,0 +1,149 @@
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger("discord_bot")
+
+
+class BackendStats:
+    """Counters for a single inference backend."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        self.total_run = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        finished = max(self.completed + self.failed, 1)
+        return {
+            "limit": self.limit,
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "max_queue_depth": self.max_queue_depth,
+            "avg_wait": self.total_wait / finished,
+            "avg_run": self.total_run / finished,
+        }
+
+
+class InferenceExecutor:
+    """
+    Runs blocking LLM calls off the event loop.
+
+    Every call goes through a per-backend semaphore so a slow backend can only
+    hold its own slots, and the blocking work itself runs on a shared, bounded
+    thread pool so the discord.py gateway keeps heartbeating while a reply is
+    being generated.
+    """
+
+    def __init__(self, max_workers: int = 4, default_limit: int = 2, limits: Dict[str, int] = None):
+        self.max_workers = max_workers
+        self.default_limit = default_limit
+        self.limits = dict(limits or {})
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference")
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._stats: Dict[str, BackendStats] = {}
+
+    def _backend(self, backend: str):
+        if backend not in self._semaphores:
+            limit = self.limits.get(backend, self.default_limit)
+            self._semaphores[backend] = asyncio.Semaphore(limit)
+            self._stats[backend] = BackendStats(limit)
+        return self._semaphores[backend], self._stats[backend]
+
+    async def _acquire(self, backend: str):
+        semaphore, stats = self._backend(backend)
+        stats.queued += 1
+        stats.max_queue_depth = max(stats.max_queue_depth, stats.queued)
+        queued_at = time.perf_counter()
+        try:
+            await semaphore.acquire()
+        except asyncio.CancelledError:
+            stats.cancelled += 1
+            raise
+        finally:
+            stats.queued -= 1
+        stats.total_wait += time.perf_counter() - queued_at
+        stats.in_flight += 1
+        return semaphore, stats
+
+    @asynccontextmanager
+    async def slot(self, backend: str):
+        """
+        Hold one concurrency slot of the given backend.
+
+        Used directly by callers that drive a native async API (e.g. token
+        streaming) and so don't need a worker thread.
+        """
+        semaphore, stats = await self._acquire(backend)
+        started_at = time.perf_counter()
+        try:
+            yield
+        except asyncio.CancelledError:
+            stats.cancelled += 1
+            raise
+        except Exception:
+            stats.failed += 1
+            raise
+        else:
+            stats.completed += 1
+        finally:
+            stats.in_flight -= 1
+            stats.total_run += time.perf_counter() - started_at
+            semaphore.release()
+
+    async def run(self, backend: str, func: Callable, *args, **kwargs) -> Any:
+        """
+        Run ``func(*args, **kwargs)`` on the worker pool under the backend's limit.
+
+        The slot is held until the worker is done with the call, even when the
+        awaiting task is cancelled or times out, so the backend never has more
+        than its limit of requests in progress. A cancelled call's result is
+        discarded.
+        """
+        semaphore, stats = await self._acquire(backend)
+        started_at = time.perf_counter()
+        loop = asyncio.get_running_loop()
+
+        def finish(future) -> None:
+            stats.in_flight -= 1
+            stats.total_run += time.perf_counter() - started_at
+            if not future.cancelled():
+                if future.exception() is None:
+                    stats.completed += 1
+                else:
+                    stats.failed += 1
+            semaphore.release()
+
+        def on_done(future) -> None:
+            # Called on the worker thread, or on the loop if the call was cancelled before it started
+            try:
+                loop.call_soon_threadsafe(finish, future)
+            except RuntimeError:
+                pass  # The loop has already been closed during shutdown
+
+        future = self._pool.submit(functools.partial(func, *args, **kwargs))
+        future.add_done_callback(on_done)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            stats.cancelled += 1
+            raise
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {backend: stats.as_dict() for backend, stats in self._stats.items()}
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+
+import aiosqlite
+from langchain.schema import AIMessage, BaseMessage, HumanMessage
+
+from helpers.custom_memory import CustomBufferWindowMemory, RingBufferChatMessageHistory
+from helpers.db_manager import MESSAGES_PATH
+
+logger = logging.getLogger("discord_bot")
+
+
+class ChannelMemoryStore:
+    """
+    Bounded, persistent conversation memory for every channel.
+
+    Each channel keeps only its last ``k * 2`` messages in RAM, and only the
+    ``max_channels`` most recently used channels stay loaded. Every message
+    added to a channel's memory is also queued for the ``chat_history`` table
+    in ``messages.db``, so an evicted channel (or the whole bot after a
+    restart) is rehydrated from disk on its next message.
+    """
+
+    def __init__(
+        self,
+        ai_prefix: str,
+        k: int = 20,
+        max_channels: int = 200,
+        flush_interval: float = 5.0,
+        path: str = MESSAGES_PATH,
+        max_token_limit: Optional[int] = None,
+        token_counter: Optional[Callable[[str], int]] = None,
+    ):
+        self.ai_prefix = ai_prefix
+        self.k = k
+        self.max_token_limit = max_token_limit
+        self.token_counter = token_counter
+        self.max_channels = max_channels
+        self.flush_interval = flush_interval
+        self.path = path
+        self._memories: "OrderedDict[str, CustomBufferWindowMemory]" = OrderedDict()
+        self._pending: List[Tuple[str, str, str, int]] = []
+        # Messages are added from the inference worker threads
+        self._pending_lock = threading.Lock()
+        # One flush at a time, so rows are committed in the order they were added
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+
+    def __contains__(self, channel_id) -> bool:
+        return str(channel_id) in self._memories
+
+    def __len__(self) -> int:
+        return len(self._memories)
+
+    async def get(self, channel_id) -> CustomBufferWindowMemory:
+        channel_id = str(channel_id)
+        memory = self._memories.get(channel_id)
+        if memory is not None:
+            self._memories.move_to_end(channel_id)
+            return memory
+
+        history = RingBufferChatMessageHistory(
+            maxlen=self.k * 2, on_add=lambda message: self._record(channel_id, message)
+        )
+        history.load(await self._load(channel_id))
+        memory = CustomBufferWindowMemory(
+            k=self.k,
+            ai_prefix=self.ai_prefix,
+            chat_memory=history,
+            max_token_limit=self.max_token_limit,
+            token_counter=self.token_counter,
+        )
+        # Another coroutine may have loaded the channel while we were reading
+        memory = self._memories.setdefault(channel_id, memory)
+        self._memories.move_to_end(channel_id)
+        while len(self._memories) > self.max_channels:
+            evicted, _ = self._memories.popitem(last=False)
+            logger.debug(f"Evicted idle channel {evicted} from memory")
+        return memory
+
+    def _record(self, channel_id: str, message: BaseMessage) -> None:
+        role = "ai" if isinstance(message, AIMessage) else "human"
+        with self._pending_lock:
+            self._pending.append((channel_id, role, message.content, int(time.time() * 1000)))
+
+    async def _load(self, channel_id: str) -> List[BaseMessage]:
+        # Rows still waiting to be written must be on disk before we read
+        await self.flush()
+        async with aiosqlite.connect(self.path) as db:
+            async with db.execute(
+                "SELECT role, content FROM chat_history WHERE channel_id=? ORDER BY id DESC LIMIT ?",
+                (channel_id, self.k * 2),
+            ) as cursor:
+                rows = await cursor.fetchall()
+        return [
+            AIMessage(content=content) if role == "ai" else HumanMessage(content=content)
+            for role, content in reversed(rows)
+        ]
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            try:
+                await self._write(pending)
+            except Exception:
+                # Put the rows back ahead of anything added meanwhile, the next flush retries them
+                with self._pending_lock:
+                    self._pending[:0] = pending
+                raise
+
+    async def _write(self, pending: List[Tuple[str, str, str, int]]) -> None:
+        async with aiosqlite.connect(self.path) as db:
+            await db.executemany(
+                "INSERT INTO chat_history(channel_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                pending,
+            )
+            # Only the window is ever read back, drop everything older
+            for channel_id in {row[0] for row in pending}:
+                await db.execute(
+                    """DELETE FROM chat_history WHERE channel_id=? AND id < (
+                        SELECT MIN(id) FROM (
+                            SELECT id FROM chat_history WHERE channel_id=? ORDER BY id DESC LIMIT ?
+                        )
+                    )""",
+                    (channel_id, channel_id, self.k * 2),
+                )
+            await db.commit()
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to persist chat history")
+
+    def start(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
@@ -0,0 +1,229 @@
+import logging
+import os
+from typing import List, Tuple
+
+import aiosqlite
+
+from helpers.db_manager import CACHE_PATH, DATABASE_PATH, MESSAGES_PATH
+
+logger = logging.getLogger("discord_bot")
+
+SCHEMA_PATH = f"{os.path.realpath(os.path.dirname(__file__))}/../database/schema.sql"
+
+# SQLite datetime text (as written by str(datetime)) to integer epoch milliseconds
+EPOCH_MS = "CAST(ROUND((julianday({column}) - 2440587.5) * 86400000) AS INTEGER)"
+
+
+def _schema() -> str:
+    with open(SCHEMA_PATH) as file:
+        return file.read()
+
+
+# Each database is at the version stored in its ``user_version`` pragma and
+# gets every later migration applied in order, each in its own transaction.
+# Never edit a migration that has shipped, add a new one instead.
+DATABASE_MIGRATIONS: List[Tuple[int, str]] = [
+    (1, _schema()),
+    (
+        2,
+        """
+        CREATE TABLE blacklist_new (
+          user_id INTEGER PRIMARY KEY,
+          created_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+        );
+        INSERT OR IGNORE INTO blacklist_new(user_id, created_at)
+          SELECT CAST(user_id AS INTEGER), CAST(strftime('%s', created_at) AS INTEGER) FROM blacklist;
+        DROP TABLE blacklist;
+        ALTER TABLE blacklist_new RENAME TO blacklist;
+
+        CREATE TABLE warns_new (
+          id INTEGER NOT NULL,
+          user_id INTEGER NOT NULL,
+          server_id INTEGER NOT NULL,
+          moderator_id INTEGER NOT NULL,
+          reason TEXT NOT NULL,
+          created_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+          PRIMARY KEY (user_id, server_id, id)
+        );
+        INSERT OR IGNORE INTO warns_new(id, user_id, server_id, moderator_id, reason, created_at)
+          SELECT id, CAST(user_id AS INTEGER), CAST(server_id AS INTEGER), CAST(moderator_id AS INTEGER),
+                 reason, CAST(strftime('%s', created_at) AS INTEGER)
+          FROM warns;
+        DROP TABLE warns;
+        ALTER TABLE warns_new RENAME TO warns;
+        """,
+    ),
+]
+
+MESSAGES_MIGRATIONS: List[Tuple[int, str]] = [
+    (
+        1,
+        """
+        CREATE TABLE IF NOT EXISTS log_message(
+            id INTEGER,
+            guild_id INTEGER,
+            channel_id INTEGER,
+            author_id INTEGER,
+            author_name TEXT,
+            author_display_name TEXT,
+            content TEXT,
+            created_at TEXT,
+            edited_at TEXT,
+            jump_url TEXT,
+            mentions TEXT,
+            type INTEGER,
+            webhook_id INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS chat_history(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_chat_history_channel ON chat_history(channel_id, id);
+        """,
+    ),
+    (
+        2,
+        f"""
+        CREATE TABLE log_message_new(
+            id INTEGER PRIMARY KEY,
+            guild_id INTEGER,
+            channel_id INTEGER NOT NULL,
+            author_id INTEGER NOT NULL,
+            author_name TEXT,
+            author_display_name TEXT,
+            content TEXT,
+            created_at INTEGER NOT NULL,
+            edited_at INTEGER,
+            jump_url TEXT,
+            mentions TEXT,
+            type INTEGER,
+            webhook_id INTEGER
+        );
+        INSERT OR IGNORE INTO log_message_new
+          SELECT id, guild_id, channel_id, author_id, author_name, author_display_name, content,
+                 {EPOCH_MS.format(column="created_at")},
+                 CASE WHEN edited_at IS NULL THEN NULL ELSE {EPOCH_MS.format(column="edited_at")} END,
+                 jump_url, mentions, type, webhook_id
+          FROM log_message
+          WHERE id IS NOT NULL;
+        DROP TABLE log_message;
+        ALTER TABLE log_message_new RENAME TO log_message;
+        CREATE INDEX idx_log_message_channel_created ON log_message(channel_id, created_at);
+        CREATE INDEX idx_log_message_author ON log_message(author_id, created_at);
+        """,
+    ),
+    (
+        3,
+        """
+        DROP INDEX idx_log_message_channel_created;
+        DROP INDEX idx_log_message_author;
+        CREATE INDEX idx_log_message_channel ON log_message(channel_id, id);
+        CREATE INDEX idx_log_message_author ON log_message(author_id, id);
+        """,
+    ),
+]
+
+# Caches that can be thrown away at any time
+CACHE_MIGRATIONS: List[Tuple[int, str]] = [
+    (
+        1,
+        """
+        CREATE TABLE caption_cache(
+            key TEXT PRIMARY KEY,
+            caption TEXT NOT NULL,
+            last_used INTEGER NOT NULL
+        );
+        CREATE INDEX idx_caption_cache_last_used ON caption_cache(last_used);
+        """,
+    ),
+    (
+        2,
+        """
+        CREATE TABLE youtube_transcript(
+            video_id TEXT PRIMARY KEY,
+            transcript TEXT NOT NULL,
+            fetched_at INTEGER NOT NULL
+        );
+        CREATE TABLE youtube_summary(
+            video_id TEXT NOT NULL,
+            key TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            PRIMARY KEY (video_id, key)
+        );
+        """,
+    ),
+    (
+        3,
+        """
+        CREATE TABLE wikipedia_search(
+            query TEXT PRIMARY KEY,
+            titles TEXT NOT NULL,
+            searched_at INTEGER NOT NULL
+        );
+        CREATE TABLE wikipedia_article(
+            title TEXT PRIMARY KEY,
+            revision INTEGER NOT NULL,
+            chunks INTEGER NOT NULL,
+            checked_at INTEGER NOT NULL
+        );
+        """,
+    ),
+    (
+        4,
+        """
+        CREATE TABLE embedding(
+            model TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            row INTEGER NOT NULL,
+            PRIMARY KEY (model, hash)
+        );
+        """,
+    ),
+    (
+        5,
+        """
+        CREATE TABLE tool_cache(
+            tool TEXT NOT NULL,
+            query TEXT NOT NULL,
+            result TEXT NOT NULL,
+            fetched_at INTEGER NOT NULL,
+            PRIMARY KEY (tool, query)
+        );
+        CREATE INDEX idx_tool_cache_fetched_at ON tool_cache(fetched_at);
+        """,
+    ),
+]
+
+
+async def migrate(path: str, migrations: List[Tuple[int, str]]) -> int:
+    """
+    Bring the database at ``path`` up to the latest migration.
+
+    :param path: The SQLite database file.
+    :param migrations: ``(version, script)`` pairs in ascending order.
+    :return: The schema version the database is at afterwards.
+    """
+    async with aiosqlite.connect(path) as db:
+        async with db.execute("PRAGMA user_version") as cursor:
+            current = (await cursor.fetchone())[0]
+        for version, script in migrations:
+            if version <= current:
+                continue
+            logger.info(f"Migrating {os.path.basename(path)} to schema version {version}")
+            try:
+                await db.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {version};\nCOMMIT;")
+            except Exception:
+                await db.rollback()
+                raise
+            current = version
+        return current
+
+
+async def migrate_all() -> None:
+    await migrate(DATABASE_PATH, DATABASE_MIGRATIONS)
+    await migrate(MESSAGES_PATH, MESSAGES_MIGRATIONS)
+    await migrate(CACHE_PATH, CACHE_MIGRATIONS)
@@ -0,0 +1,187 @@
+import asyncio
+import ctypes
+import gc
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+logger = logging.getLogger("discord_bot")
+
+
+def process_rss() -> Optional[int]:
+    """Current resident set size of the bot in bytes, or None where /proc isn't available."""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, IndexError, ValueError, AttributeError):
+        return None
+
+
+def model_size(value: Any) -> int:
+    """Bytes held by the parameters and buffers of every torch module in ``value``."""
+    if isinstance(value, (tuple, list)):
+        return sum(model_size(item) for item in value)
+    if not hasattr(value, "parameters") or not hasattr(value, "buffers"):
+        return 0
+    tensors = list(value.parameters()) + list(value.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def _release_memory() -> None:
+    gc.collect()
+    # glibc keeps freed arenas mapped, ask it to hand them back to the OS
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class _Entry:
+    def __init__(self, name: str, loader: Callable[[], Any], prewarm: bool):
+        self.name = name
+        self.loader = loader
+        self.prewarm = prewarm
+        self.value: Any = None
+        self.lock = asyncio.Lock()
+        self.users = 0
+        self.last_used = 0.0
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.size = 0
+        self.rss_delta: Optional[int] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.value is not None
+
+
+class ModelRegistry:
+    """
+    Loads heavy models on first use and unloads them once they sit idle.
+
+    Cogs register a loader under a name and borrow the model with
+    ``async with registry.use(name) as model``. The first borrower loads it
+    on a worker thread while concurrent borrowers wait on the same load.
+    A model is never unloaded while borrowed; once nobody has used it for
+    ``idle_timeout`` seconds the reference is dropped so its memory can be
+    reclaimed, and the next borrower loads it again.
+    """
+
+    def __init__(self, idle_timeout: float = 900.0, check_interval: float = 60.0):
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self._entries: Dict[str, _Entry] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, name: str, loader: Callable[[], Any], prewarm: bool = False) -> None:
+        """
+        :param name: The name the model is borrowed by.
+        :param loader: Blocking function that builds the model, run on a worker thread.
+        :param prewarm: Load the model in the background once the bot is connected.
+        """
+        entry = self._entries.get(name)
+        if entry is None:
+            self._entries[name] = _Entry(name, loader, prewarm)
+        else:
+            # Reloaded cogs keep an already loaded model, the new loader is used next time
+            entry.loader = loader
+            entry.prewarm = prewarm
+
+    async def get(self, name: str) -> Any:
+        entry = self._entries[name]
+        entry.last_used = time.monotonic()
+        if entry.loaded:
+            return entry.value
+        async with entry.lock:
+            if not entry.loaded:
+                await self._load(entry)
+        return entry.value
+
+    @asynccontextmanager
+    async def use(self, name: str) -> AsyncIterator[Any]:
+        entry = self._entries[name]
+        entry.users += 1
+        try:
+            yield await self.get(name)
+        finally:
+            entry.users -= 1
+            entry.last_used = time.monotonic()
+
+    async def _load(self, entry: _Entry) -> None:
+        logger.info(f"Loading model {entry.name}")
+        rss_before = process_rss()
+        started = time.perf_counter()
+        value = await asyncio.to_thread(entry.loader)
+        entry.load_seconds = time.perf_counter() - started
+        rss_after = process_rss()
+        entry.rss_delta = rss_after - rss_before if rss_before is not None and rss_after is not None else None
+        entry.size = model_size(value)
+        entry.loads += 1
+        entry.value = value
+        entry.last_used = time.monotonic()
+        logger.info(f"Loaded model {entry.name} in {entry.load_seconds:.1f}s ({entry.size / 2**20:.0f} MiB of weights)")
+
+    async def unload(self, name: str) -> bool:
+        """
+        Drop a model that nobody is using.
+
+        :return: Whether the model was unloaded.
+        """
+        entry = self._entries.get(name)
+        if entry is None or not entry.loaded or entry.users:
+            return False
+        async with entry.lock:
+            if entry.users or not entry.loaded:
+                return False
+            entry.value = None
+            entry.size = 0
+        await asyncio.to_thread(_release_memory)
+        logger.info(f"Unloaded model {name}")
+        return True
+
+    async def prewarm(self) -> None:
+        # One at a time, so prewarming never competes with itself for memory bandwidth
+        for entry in list(self._entries.values()):
+            if entry.prewarm and not entry.loaded:
+                try:
+                    await self.get(entry.name)
+                except Exception:
+                    logger.exception(f"Prewarming model {entry.name} failed")
+
+    async def _run(self) -> None:
+        await self.prewarm()
+        while True:
+            await asyncio.sleep(self.check_interval)
+            if self.idle_timeout <= 0:
+                continue
+            now = time.monotonic()
+            for entry in list(self._entries.values()):
+                if entry.loaded and not entry.users and now - entry.last_used > self.idle_timeout:
+                    await self.unload(entry.name)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    def stats(self) -> List[dict]:
+        now = time.monotonic()
+        return [
+            {
+                "name": entry.name,
+                "loaded": entry.loaded,
+                "in_use": entry.users,
+                "loads": entry.loads,
+                "load_seconds": entry.load_seconds,
+                "size": entry.size,
+                "rss_delta": entry.rss_delta,
+                "idle": now - entry.last_used if entry.last_used else None,
+                "prewarm": entry.prewarm,
+            }
+            for entry in self._entries.values()
+        ]
@@ -0,0 +1,327 @@
+import asyncio
+import bisect
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+import aiosqlite
+import numpy as np
+
+from helpers.db_manager import MESSAGES_PATH
+
+logger = logging.getLogger("discord_bot")
+
+DISCORD_EPOCH_MS = 1420070400000
+# Messages are logged in batches, and a streamed reply is only logged once it
+# has finished, so rows newer than this may still be missing from messages.db.
+# They are in the short-term window anyway.
+SETTLE_SECONDS = 300
+# Snippets less similar to the message than this are never recalled
+MIN_SCORE = 0.5
+# Too short to say anything worth recalling
+MIN_CHARS = 8
+
+
+def snowflake_at(seconds: float) -> int:
+    """The smallest Discord id created at the given epoch time."""
+    return max(int(seconds * 1000) - DISCORD_EPOCH_MS, 0) << 22
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class ChannelIndex:
+    """The newest ``size`` embedded messages of one channel, oldest first."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.vectors: Optional[np.ndarray] = None
+        self.ids: List[int] = []
+        self.lines: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, ids: List[int], lines: List[str], vectors: np.ndarray) -> None:
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        self.vectors = vectors if self.vectors is None else np.concatenate([self.vectors, vectors])
+        self.ids.extend(ids)
+        self.lines.extend(lines)
+        if len(self.ids) > self.size:
+            self.vectors = self.vectors[-self.size :]
+            del self.ids[: -self.size]
+            del self.lines[: -self.size]
+
+    def search(self, vector: np.ndarray, k: int, before: Optional[int] = None) -> List[Tuple[float, int]]:
+        """
+        Exact cosine search.
+
+        :param before: Only search messages with a smaller id than this.
+        :return: ``(score, position)`` pairs, best first.
+        """
+        count = len(self.ids) if before is None else bisect.bisect_left(self.ids, before)
+        if count <= 0 or k <= 0:
+            return []
+        scores = self.vectors[:count] @ vector
+        if k < count:
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(count)
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), int(i)) for i in top if scores[i] >= MIN_SCORE]
+
+
+class SemanticMemory:
+    """
+    Long-term recall of what was said in each channel.
+
+    A background task follows ``log_message`` in ``messages.db`` by id and
+    embeds every new message through the shared embedding service, so the
+    vectors are cached and a restart only re-reads them. Each channel keeps
+    its newest ``index_size`` vectors in one normalized matrix, searched
+    exactly with a single matrix product. At that size this takes a
+    millisecond or two, so no approximate index is needed.
+
+    The newest ``window`` messages of a channel are already in its
+    short-term history and are never recalled. Their ids are tracked in
+    memory through :meth:`note`, so recalling costs one query embedding and
+    a matrix product, no database access.
+
+    Only the ``max_channels`` most recently active channels keep their index
+    in RAM. An evicted channel is rebuilt from ``messages.db`` and the cached
+    vectors the next time something is recalled for it.
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        max_tokens: int = 512,
+        top_k: int = 4,
+        index_size: int = 5000,
+        max_channels: int = 200,
+        window: int = 0,
+        poll_interval: float = 10.0,
+        page_size: int = 256,
+        path: str = MESSAGES_PATH,
+        token_counter: Optional[Callable[[str], int]] = None,
+    ):
+        self.embeddings = embeddings
+        self.max_tokens = max_tokens
+        self.top_k = top_k
+        self.index_size = index_size
+        self.max_channels = max_channels
+        self.window = window
+        self.poll_interval = poll_interval
+        self.page_size = page_size
+        self.path = path
+        self.token_counter = token_counter
+        self.channels: "OrderedDict[int, ChannelIndex]" = OrderedDict()
+        self._evicted: Set[int] = set()
+        # Ids of each channel's newest window messages, oldest first
+        self._recent: Dict[int, Deque[int]] = {}
+        self._loading: Dict[int, asyncio.Task] = {}
+        self.cursor = 0
+        self._cutoffs: Dict[int, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.indexed = 0
+        self.recalls = 0
+        self.recalled = 0
+        self.recall_time = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_tokens > 0 and self.top_k > 0
+
+    async def start(self) -> None:
+        if not self.enabled:
+            return
+        # Only the newest index_size messages of each channel are worth embedding on a fresh start
+        async with aiosqlite.connect(self.path) as db:
+            async with db.execute(
+                """
+                SELECT channel_id, MIN(id) FROM (
+                    SELECT channel_id, id, ROW_NUMBER() OVER (PARTITION BY channel_id ORDER BY id DESC) AS n
+                    FROM log_message
+                ) WHERE n <= ? GROUP BY channel_id
+                """,
+                (self.index_size,),
+            ) as cursor:
+                self._cutoffs = dict(await cursor.fetchall())
+            if self.window > 0:
+                async with db.execute(
+                    """
+                    SELECT channel_id, id FROM (
+                        SELECT channel_id, id, ROW_NUMBER() OVER (PARTITION BY channel_id ORDER BY id DESC) AS n
+                        FROM log_message
+                    ) WHERE n <= ? ORDER BY id
+                    """,
+                    (self.window,),
+                ) as cursor:
+                    for channel_id, message_id in await cursor.fetchall():
+                        self.note(channel_id, message_id)
+        self.cursor = min(self._cutoffs.values(), default=1) - 1
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                caught_up = await self._index_page()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Usually the embedding model being unreachable, try again later from the same row
+                logger.warning(f"Indexing chat messages for recall failed: {e}")
+                caught_up = True
+            if caught_up:
+                await asyncio.sleep(self.poll_interval)
+
+    async def _index_page(self) -> bool:
+        """Embed the next page of settled messages. Returns whether there was less than a page left."""
+        async with aiosqlite.connect(self.path) as db:
+            async with db.execute(
+                "SELECT id, channel_id, author_display_name, content FROM log_message "
+                "WHERE id > ? AND id < ? ORDER BY id LIMIT ?",
+                (self.cursor, snowflake_at(time.time() - SETTLE_SECONDS), self.page_size),
+            ) as cursor:
+                rows = await cursor.fetchall()
+        if not rows:
+            return True
+
+        kept = [row for row in rows if self._worth_indexing(row) and row[0] >= self._cutoffs.get(row[1], 0)]
+        if kept:
+            vectors = await self.embeddings.embed([content for _, _, _, content in kept])
+            by_channel: Dict[int, List[int]] = {}
+            for i, row in enumerate(kept):
+                by_channel.setdefault(row[1], []).append(i)
+            for channel_id, positions in by_channel.items():
+                index = self.channels.get(channel_id)
+                if index is None:
+                    if channel_id in self._evicted:
+                        # Read back from messages.db along with the rest of the channel when it is reloaded
+                        continue
+                    index = self._install(channel_id, ChannelIndex(self.index_size))
+                self.channels.move_to_end(channel_id)
+                self._add(index, [kept[i] for i in positions], vectors[positions])
+        self.cursor = rows[-1][0]
+        return len(rows) < self.page_size
+
+    @staticmethod
+    def _worth_indexing(row: Tuple) -> bool:
+        content = row[3]
+        return bool(content) and len(content.strip()) >= MIN_CHARS and not content.startswith((".", "/"))
+
+    def _add(self, index: ChannelIndex, rows: List[Tuple], vectors: np.ndarray) -> None:
+        index.add([row[0] for row in rows], [f"{row[2]}: {row[3]}" for row in rows], vectors)
+        self.indexed += len(rows)
+
+    def _install(self, channel_id: int, index: ChannelIndex) -> ChannelIndex:
+        self.channels[channel_id] = index
+        self.channels.move_to_end(channel_id)
+        self._evicted.discard(channel_id)
+        while len(self.channels) > self.max_channels:
+            evicted, _ = self.channels.popitem(last=False)
+            self._evicted.add(evicted)
+            logger.debug(f"Evicted the recall index of idle channel {evicted}")
+        return index
+
+    def _reload(self, channel_id: int) -> None:
+        if channel_id not in self._loading:
+            task = asyncio.create_task(self._load(channel_id))
+            self._loading[channel_id] = task
+            task.add_done_callback(lambda done: self._loading.pop(channel_id, None))
+
+    async def _load(self, channel_id: int) -> None:
+        """Rebuild an evicted channel's index from its logged messages, the vectors come from the embedding cache."""
+        try:
+            index = ChannelIndex(self.index_size)
+            upper = self.cursor
+            rows = await self._channel_rows(
+                "WHERE channel_id=? AND id <= ? ORDER BY id DESC LIMIT ?", (channel_id, upper, self.index_size)
+            )
+            await self._embed_into(index, rows[::-1])
+            # Pages indexed meanwhile skipped this channel, pick their rows up too
+            while self.cursor > upper:
+                lower, upper = upper, self.cursor
+                rows = await self._channel_rows(
+                    "WHERE channel_id=? AND id > ? AND id <= ? ORDER BY id", (channel_id, lower, upper)
+                )
+                await self._embed_into(index, rows)
+            self._install(channel_id, index)
+        except Exception as e:
+            logger.warning(f"Reloading the recall index of channel {channel_id} failed: {e}")
+
+    async def _channel_rows(self, where: str, params: Tuple) -> List[Tuple]:
+        async with aiosqlite.connect(self.path) as db:
+            async with db.execute(
+                f"SELECT id, channel_id, author_display_name, content FROM log_message {where}", params
+            ) as cursor:
+                return [row for row in await cursor.fetchall() if self._worth_indexing(row)]
+
+    async def _embed_into(self, index: ChannelIndex, rows: List[Tuple]) -> None:
+        for start in range(0, len(rows), self.page_size):
+            page = rows[start : start + self.page_size]
+            self._add(index, page, await self.embeddings.embed([row[3] for row in page]))
+
+    def note(self, channel_id, message_id: int) -> None:
+        """Track a message that went into the channel's short-term history (a logged message or reply)."""
+        if self.window > 0:
+            self._recent.setdefault(int(channel_id), deque(maxlen=self.window)).append(message_id)
+
+    async def recall(self, channel_id, query: str) -> List[str]:
+        """
+        Past messages of a channel most related to ``query``, leaving out the short-term window.
+
+        :return: Prompt lines, oldest first, that together fit in ``max_tokens``.
+        """
+        channel_id = int(channel_id)
+        if not self.enabled or not query.strip():
+            return []
+        index = self.channels.get(channel_id)
+        if index is None:
+            if channel_id in self._evicted:
+                # Nothing to recall from this time, the next reply has it back
+                self._reload(channel_id)
+            return []
+        self.channels.move_to_end(channel_id)
+        before = None
+        if self.window > 0:
+            recent = self._recent.get(channel_id)
+            if recent is None or len(recent) < self.window:
+                return []  # The whole channel fits in the short-term history
+            before = min(recent)
+        started = time.perf_counter()
+        vector = _normalize(await self.embeddings.embed_one(query))
+        hits = index.search(vector, self.top_k, before)
+
+        budget = self.max_tokens
+        chosen = []
+        for _, position in hits:
+            line = index.lines[position]
+            cost = (self.token_counter(line) if self.token_counter else len(line) // 4) + 1
+            if cost > budget:
+                continue
+            budget -= cost
+            chosen.append(position)
+        self.recalls += 1
+        self.recalled += len(chosen)
+        self.recall_time += time.perf_counter() - started
+        return [index.lines[position] for position in sorted(chosen)]
+
+    def stats(self) -> dict:
+        return {
+            "channels": len(self.channels),
+            "vectors": sum(len(index) for index in self.channels.values()),
+            "indexed": self.indexed,
+            "recalls": self.recalls,
+            "recalled": self.recalled,
+            "average_recall": self.recall_time / self.recalls if self.recalls else 0.0,
+        }
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        for task in list(self._loading.values()):
+            task.cancel()
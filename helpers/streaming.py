@@ -0,0 +1,111 @@
+import re
+import time
+from typing import List, Optional
+
+import discord
+
+DISCORD_MESSAGE_LIMIT = 2000
+SENTENCE_END = re.compile(r"[.!?…\n]")
+
+
+class StopSequenceFilter:
+    """
+    Applies stop sequences to a token stream.
+
+    ``feed`` returns the text that is safe to show so far. Text that could be
+    the beginning of a stop sequence is held back until the next token decides
+    it, and once a full stop sequence appears the stream is marked as stopped
+    and everything from the stop sequence on is dropped.
+    """
+
+    def __init__(self, stop: Optional[List[str]] = None):
+        self.stop = [sequence for sequence in (stop or []) if sequence]
+        self.text = ""
+        self.stopped = False
+
+    def feed(self, token: str) -> str:
+        if self.stopped:
+            return self.visible
+        self.text += token
+        cut = self._first_stop()
+        if cut is not None:
+            self.text = self.text[:cut]
+            self.stopped = True
+        return self.visible
+
+    @property
+    def visible(self) -> str:
+        if self.stopped:
+            return self.text
+        return self.text[: len(self.text) - self._held_back()]
+
+    def _first_stop(self) -> Optional[int]:
+        positions = [self.text.find(sequence) for sequence in self.stop]
+        positions = [position for position in positions if position != -1]
+        return min(positions) if positions else None
+
+    def _held_back(self) -> int:
+        # Longest suffix of the text that is a proper prefix of a stop sequence
+        longest = 0
+        for sequence in self.stop:
+            for length in range(min(len(sequence) - 1, len(self.text)), longest, -1):
+                if self.text.endswith(sequence[:length]):
+                    longest = length
+                    break
+        return longest
+
+
+class ProgressiveReply:
+    """
+    Sends a reply as soon as its first sentence is ready and edits it as more
+    text streams in, no more often than ``min_interval`` seconds so we stay
+    well inside Discord's per-channel edit rate limit.
+    """
+
+    def __init__(self, channel: discord.abc.Messageable, min_interval: float = 1.2, min_chars: int = 80):
+        self.channel = channel
+        self.min_interval = min_interval
+        self.min_chars = min_chars
+        self.message: Optional[discord.Message] = None
+        self._shown = ""
+        self._last_edit = 0.0
+
+    @staticmethod
+    def _clip(text: str) -> str:
+        return text.strip()[:DISCORD_MESSAGE_LIMIT]
+
+    def _ready_to_send(self, text: str) -> bool:
+        return len(text) >= self.min_chars or SENTENCE_END.search(text.strip()) is not None
+
+    async def update(self, text: str) -> None:
+        text = self._clip(text)
+        if not text or text == self._shown:
+            return
+        if self.message is None:
+            if self._ready_to_send(text):
+                await self._send(text)
+        elif time.monotonic() - self._last_edit >= self.min_interval:
+            await self._edit(text)
+
+    async def finish(self, text: str) -> Optional[discord.Message]:
+        text = self._clip(text)
+        if not text:
+            if self.message is not None:
+                await self.message.delete()
+                self.message = None
+            return None
+        if self.message is None:
+            await self._send(text)
+        elif text != self._shown:
+            await self._edit(text)
+        return self.message
+
+    async def _send(self, text: str) -> None:
+        self.message = await self.channel.send(text)
+        self._shown = text
+        self._last_edit = time.monotonic()
+
+    async def _edit(self, text: str) -> None:
+        self.message = await self.message.edit(content=text)
+        self._shown = text
+        self._last_edit = time.monotonic()
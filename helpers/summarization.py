@@ -0,0 +1,118 @@
+import logging
+import re
+from typing import List
+
+logger = logging.getLogger("discord_bot")
+
+# End of a sentence (with any closing quotes or brackets) or a blank line between paragraphs
+SENTENCE_END = re.compile(r"[.!?…]+[\"'”’)\]]*\s+|\n\s*\n")
+
+
+def sentence_ends(text: str) -> List[int]:
+    """Character offsets just past the end of every sentence in ``text``."""
+    return [match.end() for match in SENTENCE_END.finditer(text)] + [len(text)]
+
+
+def chunk_token_ids(tokenizer, text: str, max_tokens: int) -> List[List[int]]:
+    """
+    Tokenize ``text`` once and pack whole sentences into chunks of at most ``max_tokens``.
+
+    Sentences are recovered from the tokenizer's offset mapping, so the text
+    is never re-tokenized per sentence or per chunk. A single sentence longer
+    than ``max_tokens`` is split wherever it has to be.
+    """
+    encoding = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+    ends = sentence_ends(text)
+
+    sentences: List[List[int]] = []
+    current: List[int] = []
+    sentence = 0
+    for token_id, (start, _) in zip(encoding["input_ids"], encoding["offset_mapping"]):
+        while sentence < len(ends) - 1 and start >= ends[sentence]:
+            if current:
+                sentences.append(current)
+                current = []
+            sentence += 1
+        current.append(token_id)
+    if current:
+        sentences.append(current)
+
+    chunks: List[List[int]] = []
+    chunk: List[int] = []
+    for ids in sentences:
+        while len(ids) > max_tokens:
+            if chunk:
+                chunks.append(chunk)
+                chunk = []
+            chunks.append(ids[:max_tokens])
+            ids = ids[max_tokens:]
+        if len(chunk) + len(ids) > max_tokens:
+            chunks.append(chunk)
+            chunk = []
+        chunk.extend(ids)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def generate_summaries(tokenizer, model, chunks: List[List[int]], generation_kwargs: dict, batch_size: int) -> List[str]:
+    """
+    Summarize pre-tokenized chunks with padded, batched ``generate`` calls.
+
+    Chunks are batched longest first so chunks of similar length share a
+    batch and little compute is spent on padding. Blocking, run it on a
+    worker thread.
+    """
+    import torch
+
+    order = sorted(range(len(chunks)), key=lambda i: len(chunks[i]), reverse=True)
+    summaries: List[str] = [""] * len(chunks)
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        inputs = tokenizer.pad(
+            {"input_ids": [tokenizer.build_inputs_with_special_tokens(chunks[i]) for i in batch]},
+            return_tensors="pt",
+        ).to(model.device)
+        kwargs = dict(generation_kwargs)
+        # A summary can't be required to be longer than the shortest text it summarizes
+        kwargs["min_length"] = min(kwargs.get("min_length", 0), min(len(chunks[i]) for i in batch))
+        with torch.inference_mode():
+            output = model.generate(**inputs, **kwargs)
+        decoded = tokenizer.batch_decode(output, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        for i, summary in zip(batch, decoded):
+            summaries[i] = summary
+    return summaries
+
+
+def summarize_text(
+    tokenizer,
+    model,
+    text: str,
+    generation_kwargs: dict,
+    batch_size: int = 4,
+    reduce: bool = True,
+    max_passes: int = 3,
+) -> str:
+    """
+    Map-reduce summarization with a seq2seq model such as BART.
+
+    The text is split into sentence-aligned chunks that fit the model's
+    window and every chunk is summarized (map). With ``reduce`` the joined
+    chunk summaries are summarized again until they fit a single chunk or
+    ``max_passes`` is reached; otherwise the chunk summaries are joined.
+
+    :param generation_kwargs: Keyword arguments for ``model.generate``.
+    :param batch_size: Chunks summarized per ``generate`` call.
+    """
+    # Leave room for the <s> and </s> tokens around every chunk
+    max_tokens = model.config.max_position_embeddings - 2
+    chunks = chunk_token_ids(tokenizer, text, max_tokens)
+    logger.info(f"Summarizing {sum(map(len, chunks))} tokens in {len(chunks)} chunks")
+    summaries = generate_summaries(tokenizer, model, chunks, generation_kwargs, batch_size)
+    passes = 1
+    while reduce and len(summaries) > 1 and passes < max_passes:
+        chunks = chunk_token_ids(tokenizer, " ".join(summaries), max_tokens)
+        logger.info(f"Reducing {len(summaries)} chunk summaries in {len(chunks)} chunks")
+        summaries = generate_summaries(tokenizer, model, chunks, generation_kwargs, batch_size)
+        passes += 1
+    return " ".join(summaries)
@@ -0,0 +1,56 @@
+import functools
+import logging
+import os
+from typing import Optional
+
+logger = logging.getLogger("discord_bot")
+
+# Hugging Face tokenizers matching the Ollama models we run. Set TOKENIZER to override.
+MODEL_TOKENIZERS = {
+    "llama3": "NousResearch/Meta-Llama-3-8B",
+    "llama2": "NousResearch/Llama-2-7b-hf",
+    "mistral": "mistralai/Mistral-7B-v0.1",
+}
+
+
+class TokenCounter:
+    """
+    Counts tokens with the tokenizer of the active model.
+
+    Counts are memoised per string, so the history lines that get re-counted
+    for every generation only hit the tokenizer once. If no tokenizer can be
+    loaded we fall back to the usual four-characters-per-token estimate.
+    """
+
+    def __init__(self, tokenizer_name: Optional[str], cache_size: int = 8192):
+        self.tokenizer_name = tokenizer_name
+        self.tokenizer = None
+        if tokenizer_name:
+            try:
+                from transformers import AutoTokenizer
+
+                self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+            except Exception as e:
+                logger.warning(f"Could not load tokenizer {tokenizer_name} ({e}), estimating token counts")
+        self.count = functools.lru_cache(maxsize=cache_size)(self._count)
+
+    def _count(self, text: str) -> int:
+        if self.tokenizer is None:
+            return len(text) // 4 + 1
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Cut ``text`` down to its first ``max_tokens`` tokens."""
+        if self.tokenizer is None:
+            return text[: max(max_tokens - 1, 0) * 4]
+        tokens = self.tokenizer.encode(text, add_special_tokens=False)
+        if len(tokens) <= max_tokens:
+            return text
+        return self.tokenizer.decode(tokens[:max_tokens])
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_counter(model: str) -> TokenCounter:
+    """Return the shared counter for a model, loading its tokenizer on first use."""
+    tokenizer_name = os.getenv("TOKENIZER") or MODEL_TOKENIZERS.get(model.split(":")[0])
+    return TokenCounter(tokenizer_name)
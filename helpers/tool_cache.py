@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import aiosqlite
+
+from helpers.db_manager import CACHE_PATH
+
+logger = logging.getLogger("discord_bot")
+
+
+def normalize_query(query: str) -> str:
+    """Case, spacing and trailing punctuation don't change what a search returns."""
+    return " ".join(query.lower().split()).strip(" ?!.")
+
+
+class ToolCache:
+    """
+    Results of agent tool calls, kept in ``cache.db`` by tool and normalized query.
+
+    A result younger than ``ttl`` seconds is returned as is. One that is older,
+    but by no more than another ``stale_ttl`` seconds, is still returned
+    straight away while a background call refreshes it (stale-while-revalidate).
+    Anything older is fetched again. Concurrent calls for the same query share
+    one fetch. Failed fetches and "nothing found" answers are not cached, so
+    a lookup that comes up empty during an outage is tried again next time.
+    """
+
+    def __init__(self, ttl: float = 3600, stale_ttl: float = 86400, path: str = CACHE_PATH):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.path = path
+        self._inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+        self.counters: Dict[str, Dict[str, int]] = {}
+        # Per tool, the answer it gives when it found nothing
+        self.not_found: Dict[str, str] = {}
+
+    def _count(self, tool: str, counter: str) -> None:
+        counters = self.counters.setdefault(tool, {"hits": 0, "stale": 0, "misses": 0, "failed": 0})
+        counters[counter] += 1
+
+    def wrap(
+        self, tool: str, func: Callable[[str], str], not_found: Optional[str] = None
+    ) -> Callable[[str], Awaitable[str]]:
+        """
+        Cache a blocking tool function.
+
+        :param tool: The name the results are stored under.
+        :param func: Takes the query and returns the result. Called in a worker thread on a miss.
+        :param not_found: The result ``func`` returns when it found nothing, which is never stored.
+        :return: An async function of the query.
+        """
+        if not_found is not None:
+            self.not_found[tool] = not_found
+
+        async def cached(query: str) -> str:
+            return await self.get(tool, query, func)
+
+        return cached
+
+    async def get(self, tool: str, query: str, func: Callable[[str], str]) -> str:
+        key = normalize_query(query)
+        async with aiosqlite.connect(self.path) as db:
+            async with db.execute(
+                "SELECT result, fetched_at FROM tool_cache WHERE tool=? AND query=?", (tool, key)
+            ) as cursor:
+                row = await cursor.fetchone()
+        age = time.time() - row[1] if row is not None else None
+        if age is not None and age < self.ttl:
+            self._count(tool, "hits")
+            return row[0]
+        if age is not None and age < self.ttl + self.stale_ttl:
+            self._count(tool, "stale")
+            self._fetch(tool, key, query, func)
+            return row[0]
+        self._count(tool, "misses")
+        # Shielded, a caller that times out leaves the fetch running to fill the cache
+        return await asyncio.shield(self._fetch(tool, key, query, func))
+
+    def _fetch(self, tool: str, key: str, query: str, func: Callable[[str], str]) -> asyncio.Task:
+        task = self._inflight.get((tool, key))
+        if task is None:
+            task = asyncio.create_task(self._call(tool, key, query, func))
+            self._inflight[(tool, key)] = task
+            task.add_done_callback(lambda done: self._done(tool, key, done))
+        return task
+
+    def _done(self, tool: str, key: str, task: asyncio.Task) -> None:
+        self._inflight.pop((tool, key), None)
+        if not task.cancelled() and task.exception() is not None:
+            self._count(tool, "failed")
+            logger.warning(f"{tool} lookup for {key!r} failed: {task.exception()}")
+
+    async def _call(self, tool: str, key: str, query: str, func: Callable[[str], str]) -> str:
+        result = await asyncio.to_thread(func, query)
+        if result == self.not_found.get(tool):
+            return result
+        async with aiosqlite.connect(self.path) as db:
+            await db.execute(
+                "INSERT OR REPLACE INTO tool_cache(tool, query, result, fetched_at) VALUES (?, ?, ?, ?)",
+                (tool, key, result, int(time.time())),
+            )
+            await db.commit()
+        return result
+
+    async def prune(self) -> int:
+        """Delete results too old to be served even as stale. Returns how many were removed."""
+        async with aiosqlite.connect(self.path) as db:
+            cursor = await db.execute(
+                "DELETE FROM tool_cache WHERE fetched_at < ?", (int(time.time() - self.ttl - self.stale_ttl),)
+            )
+            await db.commit()
+            return cursor.rowcount
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {tool: dict(counters) for tool, counters in self.counters.items()}
+
+    def refreshing(self) -> int:
+        return len(self._inflight)
+
+    async def close(self) -> None:
+        for task in list(self._inflight.values()):
+            task.cancel()
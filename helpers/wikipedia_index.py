@@ -0,0 +1,175 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional
+
+import aiosqlite
+
+from helpers.db_manager import CACHE_PATH
+
+logger = logging.getLogger("discord_bot")
+
+INDEX_PATH = f"{os.path.realpath(os.path.dirname(__file__))}/../database/wikipedia_index"
+
+
+def chunk_id(title: str, revision: int, index: int) -> str:
+    return f"{title}|{revision}|{index}"
+
+
+class WikipediaIndex:
+    """
+    Persistent vector index of Wikipedia articles.
+
+    Articles are embedded once per revision into a Chroma collection on
+    disk, and ``cache.db`` remembers which revision of each article is
+    indexed and which articles a topic search returned. Asking about a
+    topic again only re-checks Wikipedia once the cached answers are older
+    than ``refresh_after``, so a repeat query costs a single query embedding.
+    """
+
+    def __init__(
+        self,
+        embedding,
+        embedding_model: str,
+        persist_directory: str = INDEX_PATH,
+        max_articles: int = 5,
+        refresh_after: float = 7 * 86400,
+        path: str = CACHE_PATH,
+    ):
+        self.embedding = embedding
+        # Vectors from different models can't share a collection
+        self.collection_name = "wikipedia_" + re.sub(r"[^A-Za-z0-9_-]", "_", embedding_model)[:50]
+        self.persist_directory = persist_directory
+        self.max_articles = max_articles
+        self.refresh_after = refresh_after
+        self.path = path
+        self._vectorstore = None
+        self._locks: Dict[str, asyncio.Lock] = {}
+        # Articles are fetched concurrently but written to the collection one at a time
+        self._write_lock = threading.Lock()
+
+    @property
+    def vectorstore(self):
+        with self._write_lock:
+            if self._vectorstore is None:
+                from langchain_community.vectorstores import Chroma
+
+                self._vectorstore = Chroma(
+                    collection_name=self.collection_name,
+                    persist_directory=self.persist_directory,
+                    embedding_function=self.embedding,
+                )
+        return self._vectorstore
+
+    async def search(self, topic: str) -> List[str]:
+        """Titles of the articles Wikipedia returns for ``topic``, cached in ``cache.db``."""
+        query = topic.strip().lower()
+        async with aiosqlite.connect(self.path) as db:
+            async with db.execute(
+                "SELECT titles, searched_at FROM wikipedia_search WHERE query=?", (query,)
+            ) as cursor:
+                row = await cursor.fetchone()
+        if row is not None and time.time() - row[1] < self.refresh_after:
+            return json.loads(row[0])
+
+        import wikipedia
+
+        titles = await asyncio.to_thread(wikipedia.search, topic, results=self.max_articles)
+        if not titles:
+            # Often a hiccup rather than a topic Wikipedia has nothing on, ask again next time
+            return titles
+        async with aiosqlite.connect(self.path) as db:
+            await db.execute(
+                "INSERT OR REPLACE INTO wikipedia_search(query, titles, searched_at) VALUES (?, ?, ?)",
+                (query, json.dumps(titles), int(time.time())),
+            )
+            await db.commit()
+        return titles
+
+    async def ensure_article(self, title: str) -> bool:
+        """
+        Make sure the current revision of an article is indexed.
+
+        :return: Whether the article is in the index.
+        """
+        lock = self._locks.setdefault(title, asyncio.Lock())
+        async with lock:
+            async with aiosqlite.connect(self.path) as db:
+                async with db.execute(
+                    "SELECT revision, chunks, checked_at FROM wikipedia_article WHERE title=?", (title,)
+                ) as cursor:
+                    row = await cursor.fetchone()
+            if row is not None and time.time() - row[2] < self.refresh_after:
+                return True
+
+            page = await asyncio.to_thread(self._fetch, title)
+            if page is None:
+                return row is not None
+            if row is not None and row[0] == page.revision_id:
+                chunks = row[1]
+            else:
+                started = time.perf_counter()
+                old = (row[0], row[1]) if row is not None else None
+                chunks = await asyncio.to_thread(self._index, title, page, old)
+                logger.info(
+                    f"Indexed Wikipedia article {title} revision {page.revision_id} "
+                    f"({chunks} chunks) in {time.perf_counter() - started:.1f}s"
+                )
+            async with aiosqlite.connect(self.path) as db:
+                await db.execute(
+                    "INSERT OR REPLACE INTO wikipedia_article(title, revision, chunks, checked_at) VALUES (?, ?, ?, ?)",
+                    (title, page.revision_id, chunks, int(time.time())),
+                )
+                await db.commit()
+            return True
+
+    async def ensure(self, topic: str) -> List[str]:
+        """Index the articles for ``topic`` and return the titles that are available."""
+        titles = await self.search(topic)
+        indexed = await asyncio.gather(*(self.ensure_article(title) for title in titles))
+        return [title for title, ok in zip(titles, indexed) if ok]
+
+    def retriever(self, titles: List[str], k: int = 5):
+        """A retriever limited to the given articles."""
+        where = {"title": titles[0]} if len(titles) == 1 else {"title": {"$in": titles}}
+        return self.vectorstore.as_retriever(search_kwargs={"k": k, "filter": where})
+
+    def _fetch(self, title: str) -> Optional[object]:
+        import requests
+        import wikipedia
+
+        try:
+            page = wikipedia.page(title, auto_suggest=False)
+            # Fetched lazily by the wikipedia package, load it here rather than on the event loop
+            page.revision_id
+            return page
+        except (wikipedia.exceptions.DisambiguationError, wikipedia.exceptions.PageError) as e:
+            logger.info(f"Skipping Wikipedia article {title}: {e}")
+            return None
+        except (requests.RequestException, wikipedia.exceptions.WikipediaException) as e:
+            # One article failing to download shouldn't fail the others
+            logger.warning(f"Could not fetch Wikipedia article {title}: {e!r}")
+            return None
+
+    def _index(self, title: str, page, old: Optional[tuple]) -> int:
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+        texts = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200).split_text(page.content)
+        vectorstore = self.vectorstore
+        with self._write_lock:
+            if old is not None and old[1]:
+                vectorstore.delete(ids=[chunk_id(title, old[0], i) for i in range(old[1])])
+            if texts:
+                vectorstore.add_texts(
+                    texts,
+                    metadatas=[
+                        {"title": title, "revision": page.revision_id, "source": page.url, "chunk": i}
+                        for i in range(len(texts))
+                    ],
+                    ids=[chunk_id(title, page.revision_id, i) for i in range(len(texts))],
+                )
+        return len(texts)
@@ -0,0 +1,81 @@
+import asyncio
+import hashlib
+import re
+import time
+from typing import Dict, Iterable, Optional
+
+import aiosqlite
+
+from helpers.db_manager import CACHE_PATH
+
+VIDEO_ID = re.compile(r"(?:v=|youtu\.be/|/shorts/|/embed/|/live/)([A-Za-z0-9_-]{11})")
+
+
+def video_id(url: str) -> Optional[str]:
+    """The 11 character id of a YouTube video URL, or None if the URL isn't one."""
+    match = VIDEO_ID.search(url)
+    return match.group(1) if match else None
+
+
+def summary_key(model: str, prompt: str) -> str:
+    # Changing the model, the prompt or the chunking all change the key, so stale summaries are never reused
+    return f"{model}:{hashlib.sha1(prompt.encode()).hexdigest()}"
+
+
+def _fetch_transcript(video: str) -> str:
+    from youtube_transcript_api import YouTubeTranscriptApi
+
+    if hasattr(YouTubeTranscriptApi, "get_transcript"):
+        return " ".join(entry["text"] for entry in YouTubeTranscriptApi.get_transcript(video))
+    # youtube-transcript-api 1.x
+    return " ".join(snippet.text for snippet in YouTubeTranscriptApi().fetch(video))
+
+
+async def get_transcript(video: str, path: str = CACHE_PATH) -> tuple:
+    """
+    Return the transcript of a video, from ``cache.db`` when we have fetched it before.
+
+    :return: A ``(transcript, cached)`` tuple.
+    """
+    async with aiosqlite.connect(path) as db:
+        async with db.execute("SELECT transcript FROM youtube_transcript WHERE video_id=?", (video,)) as cursor:
+            row = await cursor.fetchone()
+    if row is not None:
+        return row[0], True
+    # The transcript API is blocking HTTP, keep it off the event loop
+    transcript = await asyncio.to_thread(_fetch_transcript, video)
+    async with aiosqlite.connect(path) as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO youtube_transcript(video_id, transcript, fetched_at) VALUES (?, ?, ?)",
+            (video, transcript, int(time.time())),
+        )
+        await db.commit()
+    return transcript, False
+
+
+async def get_summaries(video: str, keys: Iterable[str], path: str = CACHE_PATH) -> Dict[str, str]:
+    """
+    Look up cached summaries of a video.
+
+    :param video: The video id.
+    :param keys: The summary keys, as made by :func:`summary_key`.
+    :return: The summaries that were found, by key.
+    """
+    keys = list(keys)
+    if not keys:
+        return {}
+    async with aiosqlite.connect(path) as db:
+        async with db.execute(
+            f"SELECT key, summary FROM youtube_summary WHERE video_id=? AND key IN ({','.join('?' * len(keys))})",
+            (video, *keys),
+        ) as cursor:
+            return dict(await cursor.fetchall())
+
+
+async def put_summary(video: str, key: str, summary: str, path: str = CACHE_PATH) -> None:
+    async with aiosqlite.connect(path) as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO youtube_summary(video_id, key, summary, created_at) VALUES (?, ?, ?, ?)",
+            (video, key, summary, int(time.time())),
+        )
+        await db.commit()
@@ -1,7 +1,10 @@
 import langchain
 from langchain.llms.base import LLM, Optional, List, Mapping, Any
-import requests
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain.schema.output import GenerationChunk
+from typing import AsyncIterator, Dict
 from pydantic import Field
+from helpers.http_client import get_client
 
 def fix_code_block(text):
     text = text.replace("'''", "```")
@@ -20,7 +23,7 @@ class KoboldApiLLM(LLM):
     def _llm_type(self) -> str:
         return "custom"
 
-    def _call(self, prompt: str, stop: Optional[List[str]]=None) -> str:
+    def _payload(self, prompt: str, stop: Optional[List[str]]) -> Dict[str, Any]:
         # Prepare the JSON data
         data = {
             "prompt": prompt,
@@ -44,12 +47,10 @@ class KoboldApiLLM(LLM):
         # Add the stop sequences to the data if they are provided
         if stop is not None:
             data["stop_sequence"] = stop
+        return data
 
-        # Send a POST request to the Kobold API with the data
-        response = requests.post(f"{self.endpoint}/api/v1/generate", json=data)
-
+    def _parse(self, json_response: Dict[str, Any], stop: Optional[List[str]]) -> str:
         # Check for the expected keys in the response JSON
-        json_response = response.json()
         if "results" in json_response and len(json_response["results"]) > 0 and "text" in json_response["results"][0]:
             # Return the generated text
             text = json_response["results"][0]["text"].strip()
@@ -67,8 +68,59 @@ class KoboldApiLLM(LLM):
         else:
             raise ValueError("Unexpected response format from Kobold API")
 
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        # Send a POST request to the Kobold API over the shared connection pool
+        json_response = get_client().post_json_sync(
+            f"{self.endpoint}/api/v1/generate", self._payload(prompt, stop)
+        )
+        return self._parse(json_response, stop)
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        json_response = await get_client().post_json(
+            f"{self.endpoint}/api/v1/generate", self._payload(prompt, stop)
+        )
+        return self._parse(json_response, stop)
+
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        # KoboldCpp streams tokens as server-sent events
+        client = get_client()
+        finished = False
+        try:
+            async for event in client.iter_sse(
+                f"{self.endpoint}/api/extra/generate/stream", self._payload(prompt, stop)
+            ):
+                token = event.get("token", "")
+                if token:
+                    if run_manager:
+                        await run_manager.on_llm_new_token(token)
+                    yield GenerationChunk(text=token)
+            finished = True
+        finally:
+            if not finished:
+                # The consumer stopped early, tell the server to stop generating too
+                try:
+                    await client.post_json(f"{self.endpoint}/api/extra/abort", {})
+                except Exception:
+                    pass
 
-    
     def __call__(self, prompt: str, stop: Optional[List[str]]=None) -> str:
         return self._call(prompt, stop)
 
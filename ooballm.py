@@ -1,17 +1,24 @@
+import json
 import langchain
 from langchain.llms.base import LLM, Optional, List, Mapping, Any
-import requests
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain.schema.output import GenerationChunk
+from typing import AsyncIterator, Dict
+import aiohttp
 from pydantic import Field
+from helpers.http_client import get_client
 
 class OobaApiLLM(LLM):
     endpoint: str = Field(...)
+    # Websocket streaming API, e.g. ws://localhost:5005. Defaults to the endpoint with a ws:// scheme.
+    stream_endpoint: Optional[str] = None
 
     @property
     def _llm_type(self) -> str:
         return "custom"
     
 
-    def _call(self, prompt: str, stop: Optional[List[str]]=None) -> str:
+    def _payload(self, prompt: str, stop: Optional[List[str]]) -> Dict[str, Any]:
         data = {
             'prompt': prompt,
             'max_new_tokens': 1800,
@@ -44,11 +51,9 @@ class OobaApiLLM(LLM):
 
         if stop is not None:
             data["stop_sequence"] = stop
+        return data
 
-        response = requests.post(f'{self.endpoint}/api/v1/generate', json=data)
-        response.raise_for_status()
-
-        json_response = response.json()
+    def _parse(self, json_response: Dict[str, Any], stop: Optional[List[str]]) -> str:
         if 'results' in json_response and len(json_response['results']) > 0 and 'text' in json_response['results'][0]:
             text = json_response['results'][0]['text'].strip()
             if stop is not None:
@@ -61,6 +66,48 @@ class OobaApiLLM(LLM):
         else:
             raise ValueError('Unexpected response format from Ooba API')
 
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        json_response = get_client().post_json_sync(f'{self.endpoint}/api/v1/generate', self._payload(prompt, stop))
+        return self._parse(json_response, stop)
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        json_response = await get_client().post_json(f'{self.endpoint}/api/v1/generate', self._payload(prompt, stop))
+        return self._parse(json_response, stop)
+
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        stream_endpoint = self.stream_endpoint or self.endpoint.replace('http', 'ws', 1)
+        # Closing the websocket early makes the webui stop generating
+        async with get_client().session().ws_connect(f'{stream_endpoint}/api/v1/stream') as ws:
+            await ws.send_json(self._payload(prompt, stop))
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    break
+                event = json.loads(msg.data)
+                if event.get('event') == 'stream_end':
+                    break
+                if event.get('event') == 'text_stream' and event.get('text'):
+                    if run_manager:
+                        await run_manager.on_llm_new_token(event['text'])
+                    yield GenerationChunk(text=event['text'])
+
     def __call__(self, prompt: str, stop: Optional[List[str]]=None) -> str:
         return self._call(prompt, stop)
 